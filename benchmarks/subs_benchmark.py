@@ -0,0 +1,84 @@
+"""Benchmark of the symbolic substitution in `SymbolicSubsFunction`.
+
+Compares the current substitution engine with the previous one, based on two
+rounds of `sympy.Basic.subs`, for a model the size of
+`examples/model_example.py` and for a model with 100 states. The functions
+are called with symbolic arguments, as when model methods are composed.
+"""
+
+
+import argparse
+import timeit
+
+import numpy as np
+import sympy
+
+from sym2num import function, utils
+
+
+def legacy_template(f):
+    """Renamed-symbol template of the substitution engine based on `subs`.
+
+    Like in the previous engine, it is built once per function, so it is
+    excluded from the timing of the calls.
+    """
+    subs = []
+    temp = {}
+    for arg in f.arguments.values():
+        for s in arg.symbols:
+            temp[s] = sympy.Symbol(f'_temp_subs_{s.name}')
+            subs.append((s, temp[s]))
+    template = np.empty(f.default_output.shape, dtype=object)
+    for ind, expr in np.ndenumerate(f.default_output):
+        template[ind] = sympy.sympify(expr).subs(subs)
+    return template, temp
+
+
+def legacy_call(f, legacy, *args):
+    """Call `f` with the substitution engine based on `sympy.Basic.subs`."""
+    template, temp = legacy
+    call_subs = {}
+    for arg, value in zip(f.arguments.values(), args):
+        for key, val in arg.subs_map(value).items():
+            call_subs[temp[key]] = val
+    output = np.empty(template.shape, object)
+    for ind, expr in np.ndenumerate(template):
+        output[ind] = sympy.sympify(expr).subs(call_subs)
+    return output
+
+
+def model_jacobian(nx):
+    """Jacobian of a synthetic model with `nx` states and its arguments."""
+    t = sympy.Symbol('t')
+    x = [sympy.Symbol(f'x{i}') for i in range(nx)]
+    f = [sympy.sin(x[i]) * x[(i + 1) % nx] + sympy.exp(-t * x[i - 1])
+         for i in range(nx)]
+    jac = utils.ndexpr_diff(f, x)
+    arguments = function.Arguments(t=t, x=x)
+    return function.SymbolicSubsFunction(arguments, jac), t, x
+
+
+def run(nx, number):
+    """Time both substitution engines for a model with `nx` states."""
+    f, t, x = model_jacobian(nx)
+    dt = sympy.Symbol('dt')
+    args = (t + dt, [xi + dt * xi**2 for xi in x])
+    legacy = legacy_template(f)
+    assert np.all(f(*args) == legacy_call(f, legacy, *args))
+
+    new = min(timeit.repeat(lambda: f(*args), number=number, repeat=3))
+    old = min(timeit.repeat(lambda: legacy_call(f, legacy, *args),
+                            number=number, repeat=1))
+    print(f'nx={nx:4d}  subs: {old / number * 1e3:10.2f} ms  '
+          f'xreplace: {new / number * 1e3:10.2f} ms  '
+          f'speedup: {old / new:6.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--number', type=int, default=1,
+                        help='number of calls per timing repetition')
+    parsed = parser.parse_args()
+
+    run(3, parsed.number)
+    run(100, parsed.number)
@@ -0,0 +1,180 @@
+"""Runtime throughput benchmark of generated functions.
+
+Times functions generated from synthetic models of growing size against
+`sympy.lambdify` of the same expressions, over batch sizes from 1 to 10**6.
+The model with `n` states has the dynamics
+
+    f[i] = sin(x[i]) * x[i+1] + exp(-t * x[i-1]) + h(x[i])
+
+with cyclic indices and a custom univariate callable `h`, whose Jacobian is
+sparse (tridiagonal with corners). As custom callables are not supported by
+the numba and C backends, the same dynamics are also generated with sympy's
+`tanh`, the numerical implementation of `h`, in place of the callable. The
+last case is a densely coupled output
+
+    g[i] = x[i] * sum(x) + cos(t * x[i])
+
+whose Jacobian is dense. The results are printed as JSON lines, one per
+case and batch size, with the number of calls per second and nanoseconds per
+batch element, so that the outputs of different commits can be diffed.
+
+Run with `python benchmarks/throughput.py --help` for the options.
+"""
+
+
+import argparse
+import importlib.metadata
+import json
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+import numpy as np
+import sympy
+
+from sym2num import function, utils, var
+
+
+def h(x, dx=0):
+    """Numerical implementation of the custom callable `h`."""
+    return [np.tanh, lambda x: 1 - np.tanh(x) ** 2][dx](x)
+
+
+def model_cases(nx):
+    """Benchmark cases of a synthetic model with `nx` states."""
+    t = sympy.Symbol('t')
+    x = [sympy.Symbol(f'x{i}') for i in range(nx)]
+    h_sym = var.UnivariateCallable('h')
+    arguments = function.Arguments(t=t, x=x, h=h_sym)
+
+    f = [sympy.sin(x[i]) * x[(i + 1) % nx] + sympy.exp(-t * x[i - 1])
+         + h_sym(x[i]) for i in range(nx)]
+    f_tanh = [sympy.sin(x[i]) * x[(i + 1) % nx] + sympy.exp(-t * x[i - 1])
+              + sympy.tanh(x[i]) for i in range(nx)]
+    g = [x[i] * sum(x) + sympy.cos(t * x[i]) for i in range(nx)]
+    yield 'f', np.array(f), arguments, {}
+    yield 'f_jac_sparse', utils.ndexpr_diff(f, x), arguments, dict(sparse=True)
+    yield 'f_tanh', np.array(f_tanh), arguments, {}
+    yield ('f_tanh_jac_sparse', utils.ndexpr_diff(f_tanh, x), arguments,
+           dict(sparse=True))
+    yield 'g_jac_dense', utils.ndexpr_diff(g, x), arguments, {}
+
+
+def best_time(stmt, repeat):
+    """Best time of a single call of `stmt`, in seconds."""
+    timer = timeit.Timer(stmt)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def lambdified(output, arguments, sparse=False):
+    """Callable of `sympy.lambdify` with the same signature as generated.
+
+    The nonzero elements are assembled into the same dense output array, or
+    array of the nonzero values in sparse mode, as the generated function.
+    """
+    t = arguments['t']
+    x = list(arguments['x'])
+    ind = [i for i, e in np.ndenumerate(output) if e != 0]
+    modules = [{'h': h}, 'numpy']
+    f = sympy.lambdify([t, *x], [output[i] for i in ind], modules=modules)
+
+    def evaluate(t, x, h):
+        values = f(t, *np.moveaxis(x, -1, 0))
+        batch_shape = np.broadcast(t, x[..., 0]).shape
+        if sparse:
+            out = np.empty(batch_shape + (len(ind),))
+            for k, value in enumerate(values):
+                out[..., k] = value
+        else:
+            out = np.zeros(batch_shape + output.shape)
+            for i, value in zip(ind, values):
+                out[(...,) + i] = value
+        return out
+    return evaluate
+
+
+def run(nx_list, batches, backends, max_elements, repeat):
+    """Iterator of the benchmark results."""
+    for nx in nx_list:
+        for case, output, arguments, options in model_cases(nx):
+            sparse = options.get('sparse', False)
+            callables = {'lambdify': lambdified(output, arguments, sparse)}
+            for backend in backends:
+                try:
+                    f = function.compile_function(
+                        case, output, arguments, backend=backend, **options
+                    )
+                except ValueError as e:
+                    print(f'skipping {backend} for {case}: {e}',
+                          file=sys.stderr)
+                else:
+                    callables[f'sym2num-{backend}'] = f
+
+            for batch in batches:
+                if batch * output.size > max_elements:
+                    continue
+                t = np.random.rand(batch)
+                x = np.random.rand(batch, nx)
+                for name, f in callables.items():
+                    f(t, x, h)  # warm-up and just-in-time compilation
+                    elapsed = best_time(lambda: f(t, x, h), repeat)
+                    yield dict(
+                        case=case, nx=nx, batch=batch, impl=name,
+                        calls_per_s=round(1 / elapsed, 3),
+                        ns_per_element=round(elapsed / batch * 1e9, 3),
+                    )
+
+
+def metadata():
+    """Description of the benchmark environment."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        version = importlib.metadata.version('sym2num')
+    except importlib.metadata.PackageNotFoundError:
+        version = None
+    return dict(
+        commit=commit, python=platform.python_version(),
+        machine=platform.machine(), numpy=np.__version__,
+        sympy=sympy.__version__, sym2num=version
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('--nx', type=int, nargs='+', default=[3, 10, 30],
+                        help='numbers of model states')
+    parser.add_argument('--max-batch-exp', type=int, default=6,
+                        help='batch sizes are powers of 10 up to 10**EXP')
+    parser.add_argument('--backends', nargs='+', default=['numpy'],
+                        help='code generation backends to benchmark')
+    parser.add_argument('--max-elements', type=int, default=2**24,
+                        help='skip cases with larger outputs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timing repetitions')
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout, help='output JSON lines file')
+    args = parser.parse_args()
+
+    batches = [10 ** k for k in range(args.max_batch_exp + 1)]
+    print(json.dumps(dict(metadata=metadata()), sort_keys=True),
+          file=args.output)
+    results = run(args.nx, batches, args.backends, args.max_elements,
+                  args.repeat)
+    for result in results:
+        print(json.dumps(result, sort_keys=True), file=args.output,
+              flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,8 @@ setup(
     tests_require=["pytest"],
     extras_require={
         "cache": ["cached_property", "methodtools"],
+        "numba": ["numba"],
+        "numexpr": ["numexpr"],
     },
     
     # metadata for upload to PyPI
@@ -1,7 +1,32 @@
-'''Sympy to numpy code generator.'''
+'''Sympy to numpy code generator.
 
+The submodules are imported lazily, on first attribute access, so that
+processes which only load previously generated code, such as through
+`sym2num.codecache`, do not import sympy, jinja2 or the code printers.
+'''
 
-from .metafun import getmaskarray
+
+import importlib
 
 
 __all__ = ['getmaskarray']
+
+
+_submodules = {
+    'cgen', 'codecache', 'export', 'function', 'metafun', 'model', 'numbagen',
+    'numexprgen', 'parallel', 'printing', 'profiling', 'utils', 'var',
+}
+"""Names of the lazily imported submodules."""
+
+
+def __getattr__(name):
+    if name == 'getmaskarray':
+        from .metafun import getmaskarray
+        return getmaskarray
+    elif name in _submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted({*globals(), *_submodules, *__all__})
@@ -0,0 +1,55 @@
+"""Command line interface of sym2num.
+
+Export generated model classes to an importable package with
+
+    python -m sym2num export package.module:ModelClass -o path/to/pkg
+
+where each model is given as `module:attribute`, with the attribute either a
+model instance or a callable returning one, such as the model class.
+"""
+
+
+import argparse
+import importlib
+
+from . import export
+
+
+def load_model(spec):
+    """Load a model from its `module:attribute` specification."""
+    modname, sep, attr = spec.partition(':')
+    if not sep or not attr:
+        raise ValueError(f"model specification `{spec}` not module:attribute")
+    obj = importlib.import_module(modname)
+    for name in attr.split('.'):
+        obj = getattr(obj, name)
+    return obj() if callable(obj) else obj
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m sym2num', description='Sympy to numpy code generator.'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser(
+        'export', help='export generated model classes to a package'
+    )
+    export_parser.add_argument('models', nargs='+', metavar='MODULE:ATTR',
+                               help='model instance or factory')
+    export_parser.add_argument('-o', '--output', required=True,
+                               help='directory of the exported package')
+    export_parser.add_argument('--backend', help='code generation backend')
+    export_parser.add_argument('--workers', type=int,
+                               help='number of code printing processes')
+    args = parser.parse_args(argv)
+
+    options = {k: v for k, v in vars(args).items()
+               if k in ('backend', 'workers') and v is not None}
+    models = [load_model(spec) for spec in args.models]
+    manifest = export.export_models(models, args.output, **options)
+    for modname, entry in manifest.items():
+        print(f"exported {entry['class_name']} to {modname}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""C backend for symbolic array function code generation.
+
+The generated function checks and unpacks its arguments like the numpy
+backend, but all output elements are computed by a kernel printed in C with
+sympy's C99 printer, which loops over the flattened broadcast dimensions.
+The kernel is compiled by the system C compiler into a shared library cached
+on disk and called through `ctypes`, by `codecache.load_kernel`, so loading
+the generated code requires neither sympy nor recompilation. Custom callables
+are not supported, as they cannot be called from C.
+"""
+
+
+import numpy as np
+from sympy.codegen.ast import float32, real
+from sympy.printing.c import C99CodePrinter
+
+from . import function, profiling, utils
+
+
+class CPrinter(C99CodePrinter):
+    """Printer of expressions in C, which rejects unsupported functions."""
+
+    def _print_not_supported(self, expr):
+        raise NotImplementedError(f"{type(expr).__name__} not supported in C")
+
+
+kernel_template_src = '''\
+#include <math.h>
+#include <stddef.h>
+
+void {{f.kernel_name}}({% for s in kernel_symbols %}const {{ctype}} *_in{{loop.index0}}, {% endfor %}{{ctype}} *_out, ptrdiff_t _n)
+{
+    for (ptrdiff_t _i = 0; _i < _n; _i++) {
+        {%- for symbol in kernel_symbols %}
+        const {{ctype}} {{printer.doprint(symbol)}} = _in{{loop.index0}}[_i];
+        {%- endfor %}
+        {%- for cse_symbol, cse_code in cse_subs %}
+        const {{ctype}} {{printer.doprint(cse_symbol)}} = {{cse_code}};
+        {%- endfor %}
+        {%- for ind, expr in kernel_code %}
+        _out[{{f.kernel_index(ind)}}] = {{expr}};
+        {%- endfor %}
+        {%- for ind, src in f.duplicates %}
+        _out[{{f.kernel_index(ind)}}] = _out[{{f.kernel_index(src)}}];
+        {%- endfor %}
+    }
+}
+'''
+"""Template of the C kernel source."""
+
+
+c_template_src = (
+    function.function_header_src
+    + function.arguments_template_src
+    + function.output_template_src
+    + '''\
+    # Evaluate the kernel over the flattened broadcast dimensions
+    {% if f.batch_last -%}
+    _batch_shape = _out_shape[{{f.out_shape | length}}:]
+    {% else -%}
+    _batch_shape = _out_shape[:len(_out_shape) - {{f.out_shape | length}}]
+    {% endif -%}
+    _in = [
+        {%- for symbol in kernel_symbols %}
+        {{np}}.ascontiguousarray({{np}}.broadcast_to({{symbol}}, _batch_shape), dtype={{np}}.{{f.kernel_dtype}}),
+        {%- endfor %}
+    ]
+    _flat_out = {{np}}.ascontiguousarray(_out, dtype={{np}}.{{f.kernel_dtype}})
+    _n = {{np}}.prod(_batch_shape, dtype=int)
+    {{f.kernel_name}}(*[_a.ctypes.data for _a in _in], _flat_out.ctypes.data, _n)
+    if _flat_out is not _out:
+        _out[...] = _flat_out.reshape(_out_shape)
+    return _out
+''')
+"""Template of the generated function calling the C kernel."""
+
+
+class CFunctionPrinter(function.KernelFunctionPrinter):
+    """Generates code of symbolic array functions evaluated by C kernels."""
+
+    template_src = c_template_src
+    """Source of the function definition template."""
+
+    kernel_template_src = kernel_template_src
+    """Source of the C kernel template."""
+
+    ctypes = {'float64': 'double', 'float32': 'float'}
+    """C types of the supported output dtypes."""
+
+    def __init__(self, name, output, arguments, **options):
+        super().__init__(name, output, arguments, **options)
+
+        if self.threads:
+            msg = "threads not supported by the C backend"
+            raise ValueError(msg)
+
+        if self.kernel_dtype not in self.ctypes:
+            msg = f"dtype {self.kernel_dtype} not supported by the C backend"
+            raise ValueError(msg)
+
+        if self.referenced_callables:
+            callables = ', '.join(sorted(self.referenced_callables))
+            msg = f"custom callables `{callables}` not supported in C"
+            raise ValueError(msg)
+
+    @property
+    def kernel_dtype(self):
+        """Name of the numpy dtype of the kernel arrays."""
+        return self.dtype or 'float64'
+
+    def kernel_index(self, ind):
+        """Code of the flat index of an output element of a kernel iteration.
+
+        The output array is C-contiguous, with the flattened broadcast
+        dimensions first or last according to the layout.
+        """
+        out_shape = self.out_shape
+        offset = np.ravel_multi_index(ind, out_shape) if out_shape else 0
+        if self.batch_last:
+            return f'{offset}*_n + _i'
+        else:
+            return f'_i*{int(np.prod(out_shape, dtype=int))} + {offset}'
+
+    @utils.cached_property
+    @profiling.activates_profile
+    def _printed_kernel(self):
+        """Source of the C kernel."""
+        settings = {}
+        if self.kernel_dtype == 'float32':
+            settings['type_aliases'] = {real: float32}
+        printer = CPrinter(settings)
+        with profiling.phase('print', self.kernel_name):
+            cse_subs, (reduced,) = self._reduced
+            cse_subs = self.subexpressions + cse_subs
+            context = dict(
+                f=self,
+                printer=printer,
+                ctype=self.ctypes[self.kernel_dtype],
+                kernel_symbols=self.kernel_symbols,
+                cse_subs=[(s, printer.doprint(e)) for s, e in cse_subs],
+                kernel_code=list(self.kernel_code(printer)),
+            )
+        with profiling.phase('render', self.kernel_name):
+            return self.kernel_template.render(context)
+
+    def print_imports(self):
+        """List of the module-level imports required by the generated code."""
+        imports = [*super().print_imports(),
+                   'from sym2num import codecache as _codecache']
+        return list(dict.fromkeys(imports))
+
+    def print_preamble(self):
+        """Print the module-level code required by the function definition."""
+        nargs = len(self.kernel_symbols)
+        return (f"{self.kernel_name}_src = '''\\\n{self._printed_kernel}\n'''\n"
+                f"{self.kernel_name} = _codecache.load_kernel(\n"
+                f"    {self.kernel_name}_src, '{self.kernel_name}', {nargs}\n"
+                f")\n")
@@ -0,0 +1,402 @@
+"""Content-addressed cache of generated code.
+
+The cache has two levels: an in-memory LRU of the objects defined by the
+generated code and an optional on-disk store of the rendered source and the
+marshalled code objects. The keys are digests of everything that determines
+the generated code, so that a change in any of them results in a cache miss.
+
+This module does not import sympy, so that cached code can be loaded in
+processes which only run previously generated code.
+"""
+
+
+import collections
+import ctypes
+import hashlib
+import json
+import linecache
+import marshal
+import os
+import shlex
+import subprocess
+import sys
+import sysconfig
+
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'disk_hits', 'misses', 'maxsize', 'currsize']
+)
+"""Cache statistics, similar to the one of `functools.lru_cache`."""
+
+
+def _tmp_path(path):
+    """Temporary path, unique to the process, of a file being written."""
+    return f'{path}.{os.getpid()}.tmp'
+
+
+def atomic_write(path, data, mode='w'):
+    """Write `data` to the file `path` atomically.
+
+    The data is written to a temporary file first, which then replaces
+    `path`, so that concurrent processes never see partially written files.
+    The `mode` is 'w' for text, written in UTF-8, or 'wb' for bytes.
+    """
+    tmp_path = _tmp_path(path)
+    encoding = None if 'b' in mode else 'utf-8'
+    with open(tmp_path, mode, encoding=encoding) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class CodeCache:
+    """Two-level cache of generated code."""
+
+    def __init__(self, path=None, maxsize=128):
+        self.path = path
+        """Directory of the on-disk store, or None for a memory-only cache."""
+
+        self.maxsize = maxsize
+        """Maximum number of objects kept in memory."""
+
+        self._objects = collections.OrderedDict()
+        """LRU mapping of keys to the objects defined by the generated code."""
+
+        self.hits = 0
+        """Number of lookups found in memory."""
+
+        self.disk_hits = 0
+        """Number of lookups found in the on-disk store."""
+
+        self.misses = 0
+        """Number of lookups which required generating the code."""
+
+    @property
+    def code_dir(self):
+        """Directory of the code objects, specific to the interpreter."""
+        if self.path is not None:
+            return os.path.join(self.path, sys.implementation.cache_tag)
+
+    def cache_info(self):
+        """Report the cache statistics."""
+        return CacheInfo(self.hits, self.disk_hits, self.misses,
+                         self.maxsize, len(self._objects))
+
+    def cache_clear(self):
+        """Clear the in-memory cache and its statistics."""
+        self._objects.clear()
+        self.hits = self.disk_hits = self.misses = 0
+
+    def source(self, key):
+        """Rendered source code stored under `key`, or None if missing."""
+        if self.code_dir is None:
+            return None
+        try:
+            with open(self._file(key, '.py'), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def load(self, key, name, print_source):
+        """Get object `name` defined by the code cached under `key`.
+
+        If the code is not found, `print_source()` is called to render it.
+        """
+        try:
+            obj = self._objects[key]
+        except KeyError:
+            pass
+        else:
+            self._objects.move_to_end(key)
+            self.hits += 1
+            return obj
+
+        code = self._load_code(key)
+        if code is None:
+            self.misses += 1
+            source = print_source()
+            filename = self._file(key, '.py') if self.code_dir else None
+            code = compile_source(source, name, filename=filename)
+            self._store_code(key, source, code)
+        else:
+            self.disk_hits += 1
+
+        env = {}
+        exec(code, env)
+        obj = env[name]
+        self._remember(key, obj)
+        return obj
+
+    def load_data(self, key):
+        """Get the JSON data stored under `key`, or None if missing.
+
+        Used for intermediate results of the code generation, such as the
+        printed code of each method of a generated class.
+        """
+        try:
+            data = self._objects[key]
+        except KeyError:
+            pass
+        else:
+            self._objects.move_to_end(key)
+            self.hits += 1
+            return data
+
+        data = None
+        if self.code_dir is not None:
+            try:
+                with open(self._file(key, '.json'), encoding='utf-8') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+        if data is None:
+            self.misses += 1
+        else:
+            self.disk_hits += 1
+            self._remember(key, data)
+        return data
+
+    def store_data(self, key, data):
+        """Store JSON data under `key`."""
+        self._remember(key, data)
+        if self.code_dir is None:
+            return
+        os.makedirs(self.code_dir, exist_ok=True)
+        atomic_write(self._file(key, '.json'), json.dumps(data))
+
+    def _remember(self, key, obj):
+        self._objects[key] = obj
+        self._objects.move_to_end(key)
+        if self.maxsize is not None and len(self._objects) > self.maxsize:
+            self._objects.popitem(last=False)
+
+    def _file(self, key, ext):
+        return os.path.join(self.code_dir, key + ext)
+
+    def _load_code(self, key):
+        if self.code_dir is None:
+            return None
+        try:
+            with open(self._file(key, '.code'), 'rb') as f:
+                return marshal.load(f)
+        except (FileNotFoundError, EOFError, ValueError, TypeError):
+            return None
+
+    def _store_code(self, key, source, code):
+        if self.code_dir is None:
+            return
+        os.makedirs(self.code_dir, exist_ok=True)
+        atomic_write(self._file(key, '.py'), source)
+        atomic_write(self._file(key, '.code'), marshal.dumps(code), 'wb')
+
+
+def register_source(filename, source):
+    """Register source code in `linecache` under `filename`.
+
+    The entry has no modification time, so that `linecache.checkcache`
+    keeps it, like the code of interactive interpreters.
+    """
+    lines = source.splitlines(keepends=True)
+    linecache.cache[filename] = (len(source), None, lines, filename)
+
+
+def compile_source(source, name, dump_dir=None, filename=None):
+    """Compile generated source code with a unique registered filename.
+
+    Unless `filename` is given, the code is compiled under the path of the
+    source dumped to a file in `dump_dir`, if given, or a synthetic filename
+    otherwise, both unique to the function or class `name` and source. The
+    source is also registered in `linecache`, so that tracebacks, debuggers
+    and profilers show the generated lines.
+    """
+    if filename is None:
+        digest = hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+        if dump_dir is None:
+            filename = f'<sym2num-{name}-{digest}>'
+        else:
+            os.makedirs(dump_dir, exist_ok=True)
+            filename = os.path.join(os.path.abspath(dump_dir),
+                                    f'{name}_{digest}.py')
+            atomic_write(filename, source)
+    register_source(filename, source)
+    return compile(source, filename, 'exec')
+
+
+_libraries = {}
+"""Shared libraries loaded by `load_library`, by digest."""
+
+
+def load_library(source):
+    """Load a shared library compiled from C source, cached on disk.
+
+    The library is compiled by the system C compiler, given by the `CC`
+    environment variable or `cc`, and stored in the `lib` subdirectory of
+    the default cache directory under the digest of the source and compiler
+    command, so that it is compiled only once.
+    """
+    compiler = shlex.split(os.environ.get('CC', 'cc'))
+    flags = ['-O2', '-shared', '-fPIC']
+    key = hashlib.sha256(repr((source, compiler, flags)).encode()).hexdigest()
+    try:
+        return _libraries[key]
+    except KeyError:
+        pass
+
+    lib_dir = os.path.join(default_cache_dir(), 'lib')
+    suffix = sysconfig.get_config_var('SHLIB_SUFFIX') or '.so'
+    filename = os.path.join(lib_dir, key + suffix)
+    if not os.path.exists(filename):
+        os.makedirs(lib_dir, exist_ok=True)
+
+        # Compile to a temporary file first, so that concurrent processes
+        # never see partially written libraries
+        source_file = os.path.join(lib_dir, key + '.c')
+        atomic_write(source_file, source)
+        command = [*compiler, *flags, '-o', _tmp_path(filename),
+                   source_file, '-lm']
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            msg = f"C compilation failed:\n{result.stderr}"
+            raise RuntimeError(msg)
+        os.replace(_tmp_path(filename), filename)
+
+    library = _libraries[key] = ctypes.CDLL(filename)
+    return library
+
+
+def load_kernel(source, name, nargs):
+    """Load the C kernel `name`, compiling its source with `load_library`.
+
+    The kernel takes pointers to its `nargs` input arrays and to its output
+    array, followed by the number of broadcast elements.
+    """
+    kernel = getattr(load_library(source), name)
+    kernel.argtypes = [ctypes.c_void_p] * (nargs + 1) + [ctypes.c_ssize_t]
+    kernel.restype = None
+    return kernel
+
+
+def default_cache_dir():
+    """Directory of the default on-disk cache.
+
+    Given by the `SYM2NUM_CACHE_DIR` environment variable, if set.
+    """
+    try:
+        return os.environ['SYM2NUM_CACHE_DIR']
+    except KeyError:
+        base = (os.environ.get('XDG_CACHE_HOME')
+                or os.path.join(os.path.expanduser('~'), '.cache'))
+        return os.path.join(base, 'sym2num')
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Cache shared by all code generators, created on demand."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = CodeCache(default_cache_dir())
+    return _default_cache
+
+
+def get_cache(spec):
+    """Get the code cache from a code generation option.
+
+    >>> get_cache(None) is None
+    True
+    >>> get_cache(True) is default_cache()
+    True
+    >>> c = CodeCache()
+    >>> get_cache(c) is c
+    True
+
+    """
+    if spec is None or spec is False:
+        return None
+    elif spec is True:
+        return default_cache()
+    elif isinstance(spec, CodeCache):
+        return spec
+    elif isinstance(spec, (str, os.PathLike)):
+        return CodeCache(os.fspath(spec))
+    else:
+        raise TypeError("unrecognized code cache specification")
+
+
+def key_repr(obj):
+    """Stable representation of code generation inputs, for hashing.
+
+    >>> import sympy
+    >>> x, y = sympy.symbols('x, y')
+    >>> key_repr({'b': [x + y], 'a': 1})
+    "{'a': 1, 'b': [Add(Symbol('x'), Symbol('y'))]}"
+
+    """
+    import numpy as np
+    import sympy
+    from . import var
+
+    if isinstance(obj, sympy.Basic):
+        return sympy.srepr(obj)
+    elif isinstance(obj, var.CallableMeta):
+        return f'{obj.__mro__[1].__name__}({obj.name!r})'
+    elif isinstance(obj, var.SymbolArray):
+        return f'SymbolArray({obj.var_spec!r}, {obj.gen_dtype!r})'
+    elif isinstance(obj, var.SymbolObject):
+        items = ', '.join(f'{k!r}: {key_repr(v)}' for k, v in obj.items())
+        return f'{type(obj).__name__}({{{items}}})'
+    elif isinstance(obj, np.ndarray):
+        elements = ', '.join(key_repr(e) for e in obj.flat)
+        return f'ndarray({obj.dtype.str!r}, {obj.shape}, [{elements}])'
+    elif isinstance(obj, dict):
+        items = sorted((repr(k), key_repr(v)) for k, v in obj.items())
+        return '{' + ', '.join(f'{k}: {v}' for k, v in items) + '}'
+    elif isinstance(obj, (list, tuple)):
+        elements = ', '.join(key_repr(e) for e in obj)
+        return f'[{elements}]' if isinstance(obj, list) else f'({elements})'
+    elif isinstance(obj, (set, frozenset)):
+        return '{' + ', '.join(sorted(key_repr(e) for e in obj)) + '}'
+    elif callable(obj) and hasattr(obj, '__qualname__'):
+        # Functions and classes are identified by their import path, which
+        # lambdas and local definitions lack
+        if '<' in obj.__qualname__:
+            msg = f"{obj!r} has no stable cache key, use a module-level name"
+            raise TypeError(msg)
+        return f'{obj.__module__}.{obj.__qualname__}'
+    elif ' at 0x' in repr(obj):
+        raise TypeError(f"{obj!r} has no stable cache key")
+    else:
+        return repr(obj)
+
+
+_code_version = None
+
+
+def code_version():
+    """Digest of the code generators which determine the generated code.
+    
+    It covers the sources of the sym2num modules and the sympy version, so
+    that upgrading or editing them invalidates the cached code.
+    """
+    global _code_version
+    if _code_version is None:
+        import sympy
+        
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha256(sympy.__version__.encode('utf-8'))
+        for filename in sorted(os.listdir(package_dir)):
+            if filename.endswith('.py'):
+                with open(os.path.join(package_dir, filename), 'rb') as f:
+                    h.update(filename.encode('utf-8') + b'\0' + f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def digest(*items):
+    """Hexadecimal digest of the stable representation of `items`.
+    
+    The `code_version` is also included, so that the keys change with the
+    code generators.
+    """
+    text = key_repr((code_version(), items))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
@@ -0,0 +1,85 @@
+"""Ahead-of-time export of generated model classes to Python packages.
+
+The exported package has one module per model with the generated class code,
+an `__init__` importing all the generated classes, the compiled `.pyc` files
+and a `manifest.json` with the hashes of the symbolic expressions of each
+model. The package depends only on the modules imported by the generated
+code, usually only numpy, so it can be deployed to workers without sympy and
+imported without any code generation.
+"""
+
+
+import compileall
+import hashlib
+import json
+import os
+import re
+
+from . import codecache, model
+
+
+manifest_name = 'manifest.json'
+"""Name of the manifest file of the exported packages."""
+
+
+def module_name(class_name):
+    """Module name of a generated class, in snake case.
+
+    >>> module_name('GeneratedExampleModel')
+    'generated_example_model'
+
+    """
+    return re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', class_name).lower()
+
+
+def export_models(models, path, **options):
+    """Export the code of symbolic models to a package in `path`.
+
+    The `models` are either a sequence of models, exported to modules named
+    after their generated classes, or a mapping of module names to models.
+    The `options` are passed to the `ModelPrinter` of each model. Returns the
+    manifest of the exported package.
+    """
+    if not isinstance(models, dict):
+        printers = [model.ModelPrinter(m, **options) for m in models]
+        modules = {module_name(p.name): p for p in printers}
+    else:
+        modules = {k: model.ModelPrinter(m, **options)
+                   for k, m in models.items()}
+
+    os.makedirs(path, exist_ok=True)
+    manifest = {}
+    for modname, printer in modules.items():
+        source = printer.print_class()
+        codecache.atomic_write(os.path.join(path, f'{modname}.py'), source)
+        functions = {
+            fname: codecache.digest(subexpressions, output,
+                                    list(arguments.items()))
+            for fname, subexpressions, output, arguments
+            in printer.function_specs
+        }
+        manifest[modname] = dict(
+            class_name=printer.name,
+            cache_key=printer.cache_key,
+            source_sha256=hashlib.sha256(source.encode('utf-8')).hexdigest(),
+            functions=functions,
+        )
+
+    init_lines = ['"""Generated model classes exported by sym2num."""', '']
+    for modname, printer in modules.items():
+        init_lines.append(f'from .{modname} import {printer.name}')
+    all_names = ', '.join(repr(p.name) for p in modules.values())
+    init_lines += ['', f'__all__ = [{all_names}]', '']
+    codecache.atomic_write(os.path.join(path, '__init__.py'),
+                           '\n'.join(init_lines))
+    manifest_json = json.dumps(manifest, indent=2, sort_keys=True) + '\n'
+    codecache.atomic_write(os.path.join(path, manifest_name), manifest_json)
+
+    compileall.compile_dir(path, maxlevels=0, quiet=1, force=True)
+    return manifest
+
+
+def read_manifest(path):
+    """Read the manifest of an exported package."""
+    with open(os.path.join(path, manifest_name), encoding='utf-8') as f:
+        return json.load(f)
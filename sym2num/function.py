@@ -1,15 +1,23 @@
 """Sympy numeric function generation."""
 
 
+import collections
 import functools
 import inspect
+import os
 import warnings
 
 import jinja2
 import numpy as np
 import sympy
 
-from . import utils, printing, var
+from . import codecache, profiling, utils, printing, var
+
+
+CseStats = collections.namedtuple(
+    'CseStats', ['subexpressions', 'ops_before', 'ops_after']
+)
+"""Statistics of the common subexpression elimination of a function."""
 
 
 class Arguments(var.SymbolObject):
@@ -17,28 +25,48 @@ class Arguments(var.SymbolObject):
     pass
 
 
+def function_printer_class(backend=None):
+    """Function printer class of a code generation backend."""
+    if backend is None or backend == 'numpy':
+        return FunctionPrinter
+    elif backend == 'numba':
+        from . import numbagen
+        return numbagen.NumbaFunctionPrinter
+    elif backend == 'numexpr':
+        from . import numexprgen
+        return numexprgen.NumexprFunctionPrinter
+    elif backend == 'c':
+        from . import cgen
+        return cgen.CFunctionPrinter
+    else:
+        raise ValueError(f"unknown code generation backend '{backend}'")
+
+
+def function_printer(name, output, arguments, **options):
+    """Create the function printer of the backend given in the options."""
+    cls = function_printer_class(options.get('backend'))
+    return cls(name, output, arguments, **options)
+
+
 def print_function(name, output, arguments, **options):
-    return FunctionPrinter(name, output, arguments, **options).print_def()
+    return function_printer(name, output, arguments, **options).print_code()
 
 
 def compile_function(name, output, arguments, **options):
-    return FunctionPrinter(name, output, arguments, **options).callable()
+    return function_printer(name, output, arguments, **options).callable()
 
 
-function_template_src = '''\
-def {{f.name}}({{f.argument_names | join(', ')}}):
+function_header_src = '''\
+def {{f.name}}({% for name in f.argument_names %}{{name}}, {% endfor %}*, out=None):
     """Generated function `{{f.name}}` from sympy array expression."""
-    # Function imports
-    import numpy as {{np}}
-    {% for mod in printer.direct_imports if mod != 'numpy' -%}
-    import {{mod}}
-    {% endfor -%}
-    {% for mod, alias in printer.aliased_imports if mod != 'numpy' -%}
-    import {{mod}} as {{alias}}
-    {% endfor %}
+'''
+"""Template of the generated function signature."""
+
+
+arguments_template_src = '''\
     # Process and convert all arguments to ndarray
     {%- for argname, arg in f.array_arguments() %}
-    {%- set dtype %}{{np}}.{{arg.gen_dtype}}{% endset %}
+    {%- set dtype %}{{np}}.{{f.argument_dtype(arg)}}{% endset %}
     _{{argname}}_asarray = {{np}}.asanyarray({{argname}}, dtype={{dtype}})
     {%- endfor %}
     {%- for argname, fname in f.callable_arguments() 
@@ -48,22 +76,27 @@ def {{f.name}}({{f.argument_names | join(', ')}}):
     {%- for argname, arg in f.array_arguments() %}
     {% if arg.ndim -%}
     # Check shape of {{argname}}
+    {%- if f.batch_last %}
+    if _{{argname}}_asarray.shape[:{{arg.ndim}}] != {{arg.shape}}:
+        {%- set expected %}({{arg.shape |join(",")}},...){% endset %}
+    {%- else %}
     if _{{argname}}_asarray.shape[-{{arg.ndim}}:] != {{arg.shape}}:
         {%- set expected %}(...,{{arg.shape |join(",")}}){% endset %}
+    {%- endif %}
         shape = _{{argname}}_asarray.shape
         msg = f'wrong shape for {{argname}}, expected {{expected}}, got {shape}'
         raise ValueError(msg)
     {% endif %}    
     # Unpack {{argname}}
     {% for ind, symbol in arg.ndenumerate() if symbol in used_symbols -%}
-    {{symbol}} = _{{argname}}_asarray[..., {{ind | join(", ")}}]
+    {{symbol}} = _{{argname}}_asarray[{{f.index_code(ind)}}]
     {% endfor -%}
     {%- endfor %}
     {%- for argname, arg in f.object_arguments() %}
     # Unpack {{argname}}
     {% for attr, ind, symbol in arg.ndenumerate() if symbol in used_symbols -%}
     {% if ind -%}
-    {{symbol}} = {{argname}}.{{attr}}[..., {{ind | join(", ")}}]
+    {{symbol}} = {{argname}}.{{attr}}[{{f.index_code(ind)}}]
     {% else -%}
     {{symbol}} = {{argname}}.{{attr}}
     {% endif -%}
@@ -72,32 +105,207 @@ def {{f.name}}({{f.argument_names | join(', ')}}):
     {{fname}} = {{argname}}.{{attr}}
     {% endfor -%}
     {%- endfor %}
-    {% if cse_subs %}# Calculate the common subexpressions
-    {% endif -%}
-    {% for cse_symbol, cse_expr in cse_subs -%}
-    {{cse_symbol}} = {{printer.doprint(cse_expr)}}
-    {% endfor -%}
+'''
+"""Template of the generated code to check and unpack the arguments."""
+
+
+output_template_src = '''\
     {% if broadcast_elements -%}
     # Broadcast the input arguments
     _broadcast = {{np}}.broadcast({{broadcast_elements | join(', ')}})
-    _out = {{np}}.zeros(_broadcast.shape + {{f.output.shape}})
+    {% if f.batch_last -%}
+    _out_shape = {{f.out_shape}} + _broadcast.shape
     {% else -%}
-    _out = {{np}}.zeros({{f.output.shape}})
+    _out_shape = _broadcast.shape + {{f.out_shape}}
+    {% endif -%}
+    {% else -%}
+    _out_shape = {{f.out_shape}}
     {% endif %}
+    # Prepare the output array
+    if out is not None:
+        if out.shape != _out_shape:
+            msg = f'wrong shape for out, expected {_out_shape}, got {out.shape}'
+            raise ValueError(msg)
+        _out = out
+        {%- if f.zero_ind.shape[1] and not f.assigns_zeros %}
+        _out[{{f.index_code(f.zero_ind.tolist())}}] = 0
+        {%- endif %}
+    {%- if f.pool %}
+    else:
+        _pool = self.__dict__.setdefault('_buffer_pool', {})
+        _out = _pool.get(('{{f.name}}', _out_shape))
+        if _out is None:
+            _out = _pool['{{f.name}}', _out_shape] = {{np}}.zeros(_out_shape{{f.dtype_argument(np)}})
+    {%- elif f.assigns_zeros %}
+    else:
+        _out = {{np}}.empty(_out_shape{{f.dtype_argument(np)}})
+    {%- else %}
+    else:
+        _out = {{np}}.zeros(_out_shape{{f.dtype_argument(np)}})
+    {%- endif %}
+    
+'''
+"""Template of the generated code to prepare the output array."""
+
+
+cse_template_src = '''\
+    {% if cse_subs %}# Calculate the common subexpressions
+    {% endif -%}
+    {% for cse_symbol, cse_code in cse_subs -%}
+    {{cse_symbol}} = {{cse_code}}
+    {% endfor -%}
+    {% if cse_subs %}
+    {% endif -%}
+'''
+"""Template of the generated code of the common subexpressions."""
+
+
+assignment_template_src = '''\
     # Assign the nonzero elements of the output
     {% for ind, expr in output_code if expr != 0 -%}
-    _out[..., {{ind | join(', ')}}] = {{expr}}
+    _out[{{f.index_code(ind)}}] = {{expr}}
+    {% endfor -%}
+    {% if f.duplicates -%}
+    # Copy the duplicate elements of the output
+    {% for ind, src in f.duplicates -%}
+    _out[{{f.index_code(ind)}}] = _out[{{f.index_code(src)}}]
     {% endfor -%}
+    {% endif -%}
+'''
+"""Template of the generated code assigning the output elements."""
+
+
+chunk_template_src = (
+    '''\
+    # Evaluate the output in chunks of the broadcast elements
+    {% if f.batch_last -%}
+    _batch_shape = _out_shape[{{f.out_shape | length}}:]
+    {% else -%}
+    _batch_shape = _out_shape[:len(_out_shape) - {{f.out_shape | length}}]
+    {% endif -%}
+    if _batch_shape:
+        _batch_size = int({{np}}.prod(_batch_shape, dtype=int))
+        {%- if f.chunk_size %}
+        _chunk_size = {{f.chunk_size}}
+        {%- else %}
+        _chunk_size = _batch_size
+        {%- endif %}
+        {%- if f.threads %}
+        _chunk_size = min(_chunk_size, -(-_batch_size // {{f.threads}}))
+        {%- endif %}
+        _chunk_size = max(1, _chunk_size)
+        # Index the leading axes until the trailing ones fit in a chunk
+        _axis = 0
+        while (_axis < len(_batch_shape) - 1 and
+               {{np}}.prod(_batch_shape[_axis + 1:], dtype=int) > _chunk_size):
+            _axis += 1
+        _trailing = int({{np}}.prod(_batch_shape[_axis + 1:], dtype=int))
+        _chunk_rows = max(1, _chunk_size // _trailing)
+        _chunks = [_lead + (slice(_i, _i + _chunk_rows),)
+                   for _lead in {{np}}.ndindex(*_batch_shape[:_axis])
+                   for _i in range(0, _batch_shape[_axis], _chunk_rows)]
+    else:
+        _chunks = [(...,)]
+    _full_out = _out
+    {%- for symbol in chunk_symbols %}
+    _{{symbol}}_full = {{np}}.broadcast_to({{symbol}}, _batch_shape)
+    {%- endfor %}
+    {%- if f.threads %}
+    def _evaluate_chunk(_chunk):
+    {%- else %}
+    for _chunk in _chunks:
+    {%- endif %}
+        {%- if f.batch_last %}
+        _out = _full_out[(slice(None),) * {{f.out_shape | length}} + _chunk]
+        {%- else %}
+        _out = _full_out[_chunk]
+        {%- endif %}
+        {%- for symbol in chunk_symbols %}
+        {{symbol}} = _{{symbol}}_full[_chunk]
+        {%- endfor %}
+        
+{% filter indent(4, true) %}'''
+    + cse_template_src
+    + assignment_template_src
+    + '''\
+{% endfilter %}
+    {%- if f.threads %}
+    list({{f.executor_name}}.map(_evaluate_chunk, _chunks))
+    {%- endif %}
+    _out = _full_out
+''')
+"""Template of the generated code evaluating the output in chunks.
+
+With threads, the chunks are evaluated concurrently by an executor.
+"""
+
+
+function_template_src = (
+    function_header_src
+    + arguments_template_src
+    + '''\
+    {% if f.chunk_size or f.threads -%}
+'''
+    + output_template_src
+    + chunk_template_src
+    + '''\
+    {% else -%}
+'''
+    + cse_template_src
+    + output_template_src
+    + assignment_template_src
+    + '''\
+    {% endif -%}
     return _out
+''')
+"""Template of the generated numpy function."""
+
+
+fused_template_src = (
+    function_header_src
+    + arguments_template_src
+    + cse_template_src
+    + '''\
+    # Unpack the output arrays of the fused functions
+    _outs = [None] * {{members | length}} if out is None else list(out)
+    {% for k, member_name, member, member_code in members -%}
+    {% with f=member, output_code=member_code %}
+    # Output of `{{member_name}}`
+    out = _outs[{{k}}]
+    
 '''
+    + output_template_src
+    + assignment_template_src
+    + '''\
+    _outs[{{k}}] = _out
+    {% endwith -%}
+    {% endfor %}
+    return tuple(_outs)
+''')
+"""Template of the generated numpy fused function."""
 
 
 class FunctionPrinter:
     """Generates numpy code for symbolic array functions."""
-
+    
+    template_src = function_template_src
+    """Source of the function definition template."""
+    
+    assigns_zeros = False
+    """Whether the generated code assigns the zero elements of the output."""
+    
+    printer_class = printing.Printer
+    """Class of the printer of the output expressions."""
+    
+    auto_chunk_size = 2 ** 15
+    """Number of broadcast elements per chunk in automatic chunked mode.
+    
+    Chosen so that each temporary array of the chunk fits in the L2 cache.
+    """
+    
     @utils.cached_class_property
     def template(cls):
-        return jinja2.Template(function_template_src)
+        return jinja2.Template(cls.template_src)
     
     def __init__(self, name, output, arguments, **options):
         if not utils.isidentifier(name):
@@ -105,9 +313,14 @@ class FunctionPrinter:
         self.name = name
         """Generated function name."""
         
+        self.profile = profiling.get_profile(options.get('profile'))
+        """Profile of the code generation phases, if enabled."""
+        
         output = np.array(output, object)
-        for ind, elem in np.ndenumerate(output):
-            output[ind] = sympy.sympify(elem)
+        with profiling.activated(self.profile), \
+             profiling.phase('sympify', name):
+            for ind, elem in np.ndenumerate(output):
+                output[ind] = sympy.sympify(elem)
         self.output = output
         """Symbolic array expression of the function's output."""
         
@@ -128,6 +341,12 @@ class FunctionPrinter:
             msg = "symbols `{}` of the output are not in the input"
             raise ValueError(msg.format(', '.join(orphan_symbol_ids)))
         
+        if self.pool and next(iter(self.argument_names), None) != 'self':
+            raise ValueError("output buffer pools are only valid for methods")
+        
+        if self.selector is not None and not self.sparse:
+            raise ValueError("output selectors are only valid in sparse mode")
+        
         orphan_callables = self.referenced_callables - all_argument_ids
         if orphan_callables:
             msg = "custom callables `{}` of the output are not in the input"
@@ -158,120 +377,576 @@ class FunctionPrinter:
     
     @property
     def broadcast_elements(self):
-        """List of argument elements broadcasted to generate the output"""
+        """List of argument elements broadcasted to generate the output.
+        
+        Sorted by name, so that the generated code is deterministic.
+        """
         be = set()
         for arg in self.arguments.values():
             if isinstance(arg, var.SymbolArray) and arg.size:
                 be.add(arg.flat[0])
-        return be
+        return sorted(be, key=lambda s: s.name)
+    
+    @utils.cached_property
+    def subexpressions(self):
+        """Definitions of the intermediate symbols used in the output.
+        
+        Given by the `subexpressions` option as a sequence of `(symbol, expr)`
+        in topological order, like the DAG of `utils.ndexpr_dag_diff`, and
+        pruned of the definitions not required by the output.
+        """
+        subexpressions = [(s, sympy.sympify(e)) for s, e
+                          in self.options.get('subexpressions', [])]
+        return utils.prune_subexpressions(subexpressions, self.output.flat)
     
     @property
     def output_symbols(self):
         """Set of free symbols of the output."""
-        return utils.union(e.free_symbols for e in self.output.flat)
+        exprs = [*self.output.flat, *(e for s, e in self.subexpressions)]
+        free_symbols = utils.union(e.free_symbols for e in exprs)
+        return free_symbols - {s for s, e in self.subexpressions}
     
     @property
     def referenced_callables(self):
         """Set of the name of callables referenced by the function."""
-        atoms = utils.union(e.atoms(var.CallableBase) for e in self.output.flat)
+        exprs = [*self.output.flat, *(e for s, e in self.subexpressions)]
+        atoms = utils.union(e.atoms(var.CallableBase) for e in exprs)
         return {c.fname for c in atoms}
     
-    def output_code(self, printer):
-        """Iterator of the ndenumeration of the output code."""
-        for ind, expr in np.ndenumerate(self.output):
-            if expr != 0:
-                yield ind, printer.doprint(expr)
+    @property
+    def sparse(self):
+        """Whether to generate only the nonzero elements of the output."""
+        return self.options.get('sparse', False)
     
-    def print_def(self):
-        """Print the function definition code."""
-        printer = printing.Printer()
-        output_code = list(self.output_code(printer))
+    @property
+    def selector(self):
+        """Predicate of the output indices generated in sparse mode, or None.
+        
+        Given by the `selector` option, either a callable of the element
+        indices or the name of a predicate of `utils`, such as 'tril' for
+        `utils.istril`, for generating only one triangle of symmetric
+        matrices like Hessians.
+        """
+        selector = self.options.get('selector')
+        if isinstance(selector, str):
+            try:
+                return getattr(utils, f'is{selector}')
+            except AttributeError:
+                raise ValueError(f"unknown output selector '{selector}'")
+        return selector
+    
+    @utils.cached_property
+    def ind(self):
+        """Indices of the nonzero elements of the output, shape (ndim, nnz).
+        
+        In sparse mode these are the indices of the generated values.
+        """
+        return utils.sparsify(self.output, self.selector)[1]
+    
+    @utils.cached_property
+    def duplicates(self):
+        """Pairs `(ind, src)` of generated elements equal to a previous one.
+        
+        The duplicate elements, such as the symmetric elements of Hessians,
+        are copied from the output element at `src` instead of evaluated.
+        Atomic expressions are not deduplicated, as assigning them is as
+        cheap as copying. Disabled by setting the `dedupe` option to False.
+        """
+        if not self.options.get('dedupe', True):
+            return []
+        if self.sparse:
+            elements = [((k,), self.output[ind])
+                        for k, ind in enumerate(zip(*self.ind))]
+        else:
+            elements = np.ndenumerate(self.output)
+        
+        first = {}
+        duplicates = []
+        for ind, expr in elements:
+            if expr.is_Atom:
+                continue
+            src = first.setdefault(expr, ind)
+            if src != ind:
+                duplicates.append((ind, src))
+        return duplicates
+    
+    @property
+    def pool(self):
+        """Whether the generated method reuses its output buffers."""
+        return self.options.get('pool', False)
+    
+    @property
+    def dtype(self):
+        """Name of the numpy dtype of the output, or None for the default.
+        
+        Given by the `dtype` option. The floating-point arguments are also
+        converted to it and the non-integer constants are printed with it,
+        so that single-precision functions do not promote to double.
+        """
+        dtype = self.options.get('dtype')
+        return None if dtype is None else np.dtype(dtype).name
+    
+    def dtype_argument(self, np):
+        """Code of the dtype argument of the output allocation."""
+        return '' if self.dtype is None else f', dtype={np}.{self.dtype}'
+    
+    def argument_dtype(self, arg):
+        """Name of the numpy dtype to which an array argument is converted."""
+        if self.dtype is not None and np.dtype(arg.gen_dtype).kind == 'f':
+            return self.dtype
+        return arg.gen_dtype
+    
+    @property
+    def layout(self):
+        """Memory layout of the arrays, 'batch_first' or 'batch_last'.
+        
+        In the default 'batch_first' layout the broadcast (batch) dimensions
+        of the arguments and output come first, as in `x[..., i]`. In the
+        'batch_last' layout they come last, as in `x[i, ...]`, so that the
+        array of each element is contiguous in C order.
+        """
+        layout = self.options.get('layout', 'batch_first')
+        if layout not in ('batch_first', 'batch_last'):
+            raise ValueError(f"unknown array layout '{layout}'")
+        return layout
+    
+    @property
+    def batch_last(self):
+        """Whether the broadcast dimensions come last in the arrays."""
+        return self.layout == 'batch_last'
+    
+    def index_code(self, ind):
+        """Code indexing an element of an array in the function layout."""
+        ind = ', '.join(str(i) for i in ind)
+        if self.batch_last:
+            return f'{ind}, ...' if ind else '...'
+        else:
+            return f'..., {ind}'
+    
+    @property
+    def chunk_size(self):
+        """Number of broadcast elements evaluated per chunk, or None.
+        
+        Given by the `chunk` option, which is either the chunk size or True
+        for `auto_chunk_size`. In chunked mode the output is evaluated over
+        blocks of at most that many broadcast elements, slicing the first
+        broadcast axis whose trailing axes fit in a chunk and indexing the
+        axes before it, so that the temporary arrays of the expressions are
+        bounded by the chunk size instead of the batch size.
+        """
+        chunk = self.options.get('chunk')
+        if chunk is None or chunk is False:
+            return None
+        elif chunk is True:
+            return self.auto_chunk_size
+        elif isinstance(chunk, int) and chunk > 0:
+            return chunk
+        else:
+            raise ValueError("chunk option must be a positive int or bool")
+    
+    @property
+    def evaluated_output(self):
+        """Output with zeros in place of the elements not evaluated.
+        
+        The elements not selected in sparse mode and the duplicates, which
+        are copied, are not evaluated.
+        """
+        evaluated = np.full(self.output.shape, sympy.S.Zero, object)
+        duplicate_ind = {ind for ind, src in self.duplicates}
+        if self.sparse:
+            for k, ind in enumerate(zip(*self.ind)):
+                if (k,) not in duplicate_ind:
+                    evaluated[ind] = self.output[ind]
+        else:
+            for ind, expr in np.ndenumerate(self.output):
+                if ind not in duplicate_ind:
+                    evaluated[ind] = expr
+        return evaluated
+    
+    @property
+    def cse_settings(self):
+        """Settings of the common subexpression elimination, None if disabled.
+        
+        Given by the `cse` option, either a bool or a dict of settings
+        overriding the defaults: the `optimizations` argument of `sympy.cse`
+        and the minimum number of operations `min_ops` of the subexpressions,
+        below which they are substituted back into the expressions.
+        """
+        cse = self.options.get('cse', True)
+        if cse is None or cse is False:
+            return None
+        settings = dict(optimizations=None, min_ops=1)
+        if cse is not True:
+            unknown = set(cse) - set(settings)
+            if unknown:
+                msg = "unknown common subexpression elimination settings `{}`"
+                raise ValueError(msg.format(', '.join(sorted(unknown))))
+            settings.update(cse)
+        return settings
+    
+    def eliminate_common_subexpressions(self, outputs):
+        """Common subexpression elimination of a list of output arrays.
+        
+        Returns the list of `(symbol, expr)` substitutions and the list of
+        reduced output arrays, according to the `cse_settings`.
+        """
+        settings = self.cse_settings
+        if settings is None:
+            return [], outputs
+        
+        subs, reduced = utils.ndexpr_cse(
+            outputs, optimizations=settings['optimizations']
+        )
+        if settings['min_ops'] > 1:
+            inline = {}
+            kept = []
+            for symbol, expr in subs:
+                expr = expr.xreplace(inline)
+                if sympy.count_ops(expr) < settings['min_ops']:
+                    inline[symbol] = expr
+                else:
+                    kept.append((symbol, expr))
+            subs = kept
+            reduced = [utils.ndexpr_xreplace(r, inline) for r in reduced]
+        return subs, reduced
+    
+    @property
+    def cse_inputs(self):
+        """Arrays of the evaluated expressions, input to the CSE."""
+        return [self.evaluated_output]
+    
+    @utils.cached_property
+    def _reduced(self):
+        """Common subexpressions and reduced arrays of the `cse_inputs`."""
+        with profiling.activated(self.profile), \
+             profiling.phase('cse', self.name):
+            return self.eliminate_common_subexpressions(self.cse_inputs)
+    
+    @property
+    def cse_stats(self):
+        """Number of subexpressions and operations before and after the CSE."""
+        subs, reduced = self._reduced
+        before = [e for a in self.cse_inputs for e in a.flat]
+        after = [e for s, e in subs] + [e for a in reduced for e in a.flat]
+        return CseStats(len(subs), sum(map(sympy.count_ops, before)),
+                        sum(map(sympy.count_ops, after)))
+    
+    @property
+    def threads(self):
+        """Number of threads evaluating the output concurrently, or None.
+        
+        Given by the `threads` option, either the number of threads or True
+        for the number of CPUs. The broadcast elements are partitioned in
+        chunks as in chunked mode, of at most the batch size divided by the
+        number of threads, so there are at least as many chunks as threads
+        when there are enough elements. The chunks are evaluated concurrently
+        by a module-level thread pool shared by the generated functions with
+        the same number of threads, as numpy releases the GIL in its loops.
+        The partition depends only on the array shapes, so the results do not
+        depend on the scheduling of the threads.
+        """
+        threads = self.options.get('threads')
+        if threads is None or threads is False:
+            return None
+        elif threads is True:
+            return os.cpu_count()
+        elif isinstance(threads, int) and threads > 0:
+            return threads
+        else:
+            raise ValueError("threads option must be a positive int or bool")
+    
+    @property
+    def executor_name(self):
+        """Name of the thread pool executor of the generated code."""
+        return f'_thread_pool{self.threads}'
+    
+    @property
+    def zero_ind(self):
+        """Indices of the structurally zero elements of the output."""
+        if self.sparse:
+            return np.zeros((1, 0), int)
+        zero_ind = [ind for ind, expr in np.ndenumerate(self.output)
+                    if expr == 0]
+        return np.reshape(zero_ind, (len(zero_ind), self.output.ndim)).T
+    
+    @property
+    def out_shape(self):
+        """Shape of the generated output, excluding the broadcast dimensions."""
+        if self.sparse:
+            return self.ind.shape[1:]
+        else:
+            return self.output.shape
+    
+    def output_code(self, printer, output=None):
+        """Iterator of the ndenumeration of the output code.
+        
+        The `output` argument allows printing an expression equivalent to
+        the function's output, such as one with common subexpressions
+        replaced by symbols.
+        """
+        if output is None:
+            output = self.output
+        duplicate_ind = {ind for ind, src in self.duplicates}
+        if self.sparse:
+            for k, ind in enumerate(zip(*self.ind)):
+                if (k,) not in duplicate_ind:
+                    yield (k,), printer.doprint(output[ind])
+        else:
+            for ind, expr in np.ndenumerate(output):
+                if expr != 0 and ind not in duplicate_ind:
+                    yield ind, printer.doprint(expr)
+    
+    def template_context(self, printer):
+        """Context for rendering the code templates."""
+        cse_subs, (reduced,) = self._reduced
+        cse_subs = self.subexpressions + cse_subs
+        output_code = list(self.output_code(printer, reduced))
         broadcast_elements = self.broadcast_elements
         used_symbols = self.output_symbols.union(broadcast_elements)
-        context = dict(
+        return dict(
             f=self, 
             printer=printer, 
             np=printer.numpy_alias,
             output_code=output_code,
+            cse_subs=[(s, printer.doprint(e)) for s, e in cse_subs],
             used_symbols=used_symbols,
             broadcast_elements=broadcast_elements,
+            chunk_symbols=sorted(self.output_symbols, key=lambda s: s.name),
+        )
+    
+    @utils.cached_property
+    @profiling.activates_profile
+    def _printed_def(self):
+        """Import statements and code of the function definition."""
+        printer = self.printer_class(float_dtype=self.dtype)
+        with profiling.phase('print', self.name):
+            context = self.template_context(printer)
+        with profiling.phase('render', self.name):
+            definition = self.template.render(context)
+        return printer.import_statements(), definition
+    
+    def print_def(self):
+        """Print the function definition code."""
+        return self._printed_def[1]
+    
+    def print_imports(self):
+        """List of the module-level imports required by the generated code.
+        
+        The imports are hoisted out of the function definition, so that the
+        modules are resolved only once and not on every call.
+        """
+        imports = self._printed_def[0]
+        if self.threads:
+            imports = [*imports, 'import concurrent.futures']
+        return imports
+    
+    def print_preamble(self):
+        """Print the module-level code required by the function definition."""
+        if self.threads:
+            executor = 'concurrent.futures.ThreadPoolExecutor'
+            return f'{self.executor_name} = {executor}({self.threads})'
+        return ''
+    
+    def print_code(self):
+        """Print the function definition with its imports and preamble."""
+        parts = ['\n'.join(self.print_imports()), self.print_preamble(),
+                 self.print_def()]
+        return '\n\n\n'.join(part.rstrip() for part in parts if part) + '\n'
+    
+    @property
+    def cache_key(self):
+        """Digest of all inputs which determine the generated code."""
+        options = {k: v for k, v in self.options.items()
+                   if k not in ('cache', 'profile', 'dump_dir')}
+        return codecache.digest(
+            'function', self.template_src, self.name, self.output,
+            list(self.arguments.items()), options
         )
-        return self.template.render(context)
 
+    @profiling.activates_profile
     def callable(self):
-        env = {}
-        exec(compile(self.print_def(), '<string>', 'exec'), env)
-        return utils.wrap_with_signature(self.argument_names)(env[self.name])
+        cache = codecache.get_cache(self.options.get('cache'))
+        if cache is None:
+            source = self.print_code()
+            dump_dir = self.options.get('dump_dir')
+            with profiling.phase('compile', self.name):
+                code = codecache.compile_source(source, self.name, dump_dir)
+            env = {}
+            with profiling.phase('exec', self.name):
+                exec(code, env)
+            f = env[self.name]
+        else:
+            with profiling.phase('cache_load', self.name):
+                f = cache.load(self.cache_key, self.name, self.print_code)
+        decorator = utils.wrap_with_signature(self.argument_names,
+                                              kwonly=dict(out=None))
+        wrapper = decorator(f)
+        if self.sparse:
+            wrapper.ind = self.ind
+            wrapper.shape = self.output.shape
+        return wrapper
+
+
+class FusedFunctionPrinter(FunctionPrinter):
+    """Generates numpy code for several functions evaluated together.
+    
+    The common subexpressions of all member functions are computed only once
+    and the generated function returns the tuple of the member outputs. Its
+    `out` argument, if given, must be a sequence with one array (or None) per
+    member.
+    """
+    
+    template_src = fused_template_src
+    """Source of the function definition template."""
+    
+    def __init__(self, name, outputs, arguments, **options):
+        if options.get('backend', 'numpy') != 'numpy':
+            raise ValueError("fused functions require numpy backend")
+        if options.get('chunk') or options.get('threads'):
+            raise ValueError("fused functions cannot be chunked")
+        
+        member_options = options.get('member_options', {})
+        self.members = collections.OrderedDict()
+        """Printers of the member functions, by member name."""
+        for member_name, output in outputs.items():
+            m_options = dict(member_options.get(member_name, {}))
+            m_options.setdefault('pool', options.get('pool', False))
+            for key in ('layout', 'dtype'):
+                if key in options:
+                    m_options.setdefault(key, options[key])
+            m_options.setdefault('subexpressions',
+                                 options.get('subexpressions', []))
+            self.members[member_name] = FunctionPrinter(
+                f'{name}_{member_name}', output, arguments, **m_options
+            )
+        
+        # The output of the fused function is the concatenation of the flat
+        # member outputs, used for checking the symbols and cache keys
+        output = [e for m in self.members.values() for e in m.output.flat]
+        super().__init__(name, output, arguments, **options)
+    
+    @property
+    def cse_inputs(self):
+        """Arrays of the evaluated expressions, input to the CSE."""
+        return [m.evaluated_output for m in self.members.values()]
+    
+    def template_context(self, printer):
+        """Context for rendering the code templates."""
+        cse_subs, reduced = self._reduced
+        cse_subs = self.subexpressions + cse_subs
+        members = []
+        for k, (member_name, member) in enumerate(self.members.items()):
+            code = list(member.output_code(printer, reduced[k]))
+            members.append((k, member_name, member, code))
+        broadcast_elements = self.broadcast_elements
+        used_symbols = self.output_symbols.union(broadcast_elements)
+        return dict(
+            f=self, 
+            printer=printer, 
+            np=printer.numpy_alias,
+            members=members,
+            cse_subs=[(s, printer.doprint(e)) for s, e in cse_subs],
+            used_symbols=used_symbols,
+            broadcast_elements=broadcast_elements,
+        )
+
+
+class KernelFunctionPrinter(FunctionPrinter):
+    """Base of the printers of functions evaluated by a compiled kernel.
+    
+    The kernel loops over the flattened broadcast dimensions and computes
+    all the output elements of each broadcast element, including the zeros,
+    with scalar arithmetic. It is rendered from `kernel_template_src`.
+    """
+    
+    kernel_template_src = None
+    """Source of the kernel template."""
+    
+    assigns_zeros = True
+    """Whether the generated code assigns the zero elements of the output."""
+    
+    @utils.cached_class_property
+    def kernel_template(cls):
+        return jinja2.Template(cls.kernel_template_src)
+    
+    @property
+    def kernel_name(self):
+        """Name of the compiled kernel."""
+        return f'_{self.name}_kernel'
+    
+    @property
+    def kernel_symbols(self):
+        """Symbols passed to the kernel, sorted by name."""
+        return sorted(self.output_symbols, key=lambda s: s.name)
+    
+    def kernel_code(self, printer):
+        """Iterator of the code of all output elements, including zeros.
+        
+        The duplicate elements are excluded, as they are copied.
+        """
+        cse_subs, (reduced,) = self._reduced
+        if self.sparse:
+            yield from self.output_code(printer, reduced)
+        else:
+            duplicate_ind = {ind for ind, src in self.duplicates}
+            for ind, expr in np.ndenumerate(reduced):
+                if ind not in duplicate_ind:
+                    yield ind, printer.doprint(expr)
+    
+    def template_context(self, printer):
+        """Context for rendering the code templates."""
+        context = super().template_context(printer)
+        context.update(kernel_symbols=self.kernel_symbols)
+        return context
 
 
 class SymbolicSubsFunction:
-    def __init__(self, arguments, output):
+    def __init__(self, arguments, output, lazy=False):
         self.arguments = arguments
         
-        self.callable_replacements = {}
-        """Cache of callable replacements."""
-
-        self.default_output = np.asarray(output, object)
-        """The output for the default arguments."""
+        self._output = output
+        """Output for the default arguments, or its thunk if lazy."""
+        
+        self.lazy = lazy
+        """Whether the default output is computed only when first required."""
 
         kind = inspect.Parameter.POSITIONAL_ONLY
         params = [inspect.Parameter(name, kind) for name in arguments]
         self.__signature__ = inspect.Signature(params)
         """Function call signature."""
     
+    @utils.cached_property
+    def default_output(self):
+        """The output for the default arguments."""
+        output = self._output() if self.lazy else self._output
+        return np.asarray(output, object)
+    
     @property
     def ismethod(self):
         """Wether this function is a method."""
         for argname in self.arguments:
             return argname == 'self'
     
-    def _prepare_call(self):
-        if hasattr(self, 'output_template'):
-            return
-        
-        # Create first round of substitutions. Double substitution is needed
-        # because the same symbol may appear in the function definition and
-        # call arguments.
-        subs = []
-        for arg in self.arguments.values():
-            for s in arg.symbols:
-                subs.append((s, self.replacement(s)))
-        
-        self.output_template = np.empty(self.default_output.shape, dtype=object)
+    @utils.cached_property
+    def output_template(self):
+        """Default output with all elements sympified."""
+        output_template = np.empty(self.default_output.shape, dtype=object)
         for ind, expr in np.ndenumerate(self.default_output):
-            self.output_template[ind] = sympy.sympify(expr).subs(subs)
-    
-    def replacement(self, s):
-        if isinstance(s, sympy.Symbol):
-            return sympy.Symbol(f'_temp_subs_{s.name}')
-        elif isinstance(s, type) and issubclass(s, var.CallableBase):
-            # Caching necessary as callables with the same name are not equal
-            try:
-                return self.callable_replacements[s]
-            except KeyError:
-                if issubclass(s, var.UnivariateCallableBase):
-                    sub = var.UnivariateCallable(f'_temp_subs_{s.name}')
-                elif issubclass(s, var.BivariateCallableBase):
-                    sub = var.BivariateCallable(f'_temp_subs_{s.name}')
-                self.callable_replacements[s] = sub
-                return sub
-        else:
-            raise TypeError
+            output_template[ind] = sympy.sympify(expr)
+        return output_template
     
     def __call__(self, *args):
         if len(args) != len(self.arguments):
             msg = f'got {len(args)} arguments of {len(self.arguments)} required'
             raise TypeError(msg)
-
-        self._prepare_call()
         
-        subs = {}
+        # The replacement is simultaneous, so symbols of the function
+        # definition may also appear in the call arguments
+        mapping = {}
         for arg, value in zip(self.arguments.values(), args):
             for key, val in arg.subs_map(value).items():
-                subs[self.replacement(key)] = val
-        
-        output = np.empty(self.output_template.shape, object)
-        for ind, expr in np.ndenumerate(self.output_template):
-            output[ind] = sympy.sympify(expr).subs(subs)
+                if not isinstance(val, type):
+                    val = sympy.sympify(val)
+                mapping[key] = val
         
-        return output
+        return utils.ndexpr_xreplace(self.output_template, mapping)
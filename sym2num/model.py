@@ -1,11 +1,4 @@
-"""Symbolic model code generation.
-
-Improvement ideas
------------------
-* Add compiled code to linecache so that tracebacks can be produced, like done
-  in the `IPython.core.compilerop` module.
-
-"""
+"""Symbolic model code generation."""
 
 
 import abc
@@ -15,7 +8,9 @@ import contextlib
 import functools
 import inspect
 import itertools
+import marshal
 import re
+import sys
 import types
 
 import attrdict
@@ -23,7 +18,7 @@ import numpy as np
 import jinja2
 import sympy
 
-from . import function, printing, utils, var
+from . import codecache, function, printing, profiling, utils, var
 
 
 class Variables(var.SymbolObject):
@@ -40,6 +35,13 @@ class Base:
     
         self.derivatives = {}
         """Dictionary of model derivatives, to optimize higher order diff."""
+        
+        self.products = {}
+        """Derivative product functions, as `(kind, fname, wrt, vector)`."""
+        
+        self._product_dags = {}
+        
+        self._derivative_dags = {}
 
     def __getattribute__(self, name):
         """Overloaded method to bind SymbolicSubsFunction objects."""
@@ -49,19 +51,20 @@ class Base:
         else:
             return attr
     
-    def _compute_derivative(self, fname, wrt):
+    def _compute_derivative(self, fname, wrt, lookup=True):
         assert isinstance(wrt, tuple)
         if wrt == ():
             return self.default_function_output(fname)
         
         # See if the derivative is registered
-        dname = self.derivatives.get((fname,) + wrt)
+        dname = self.derivatives.get((fname,) + wrt) if lookup else None
         if dname is not None:
             return self.default_function_output(dname)
         
         expr = self._compute_derivative(fname, wrt[1:])
         wrt_array = self.variables[wrt[0]]
-        return utils.ndexpr_diff(expr, wrt_array)
+        with profiling.phase('differentiation', fname):
+            return utils.ndexpr_diff(expr, wrt_array)
     
     def add_derivative(self, fname, wrt, dname):
         if utils.isstr(wrt):
@@ -69,12 +72,280 @@ class Base:
         elif not isinstance(wrt, tuple):
             raise TypeError("argument wrt must be string or tuple")
         
+        # The derivative is computed lazily, so that it is skipped when the
+        # generated code is retrieved from the cache under a key which does
+        # not depend on the symbolic outputs, i.e., with the `cache_key`
+        # option or in `incremental` mode
         args = self.function_codegen_arguments(fname, include_self=True)
-        expr = self._compute_derivative(fname, wrt)
-        deriv = function.SymbolicSubsFunction(args, expr)
+        compute = functools.partial(self._compute_derivative, fname, wrt,
+                                    lookup=False)
+        deriv = function.SymbolicSubsFunction(args, compute, lazy=True)
         setattr(self, dname, deriv)
         self.derivatives[(fname,) + wrt] = dname
     
+    def add_jvp(self, fname, wrt, name, tangent=None):
+        """Add a Jacobian-vector product (forward-mode derivative) function.
+        
+        The function `name` takes the arguments of `fname` followed by the
+        tangent, an array with the shape of the variable `wrt` registered
+        as the variable `tangent`, by default `{wrt}_dot`. It returns the
+        directional derivative of `fname` along the tangent, which is the
+        derivative w.r.t. `wrt` contracted with the tangent. It is computed
+        by forward accumulation over the subexpression DAG of `fname`, so the
+        Jacobian is never materialized and the cost of the generated code is
+        a small multiple of that of `fname`.
+        """
+        if tangent is None:
+            tangent = f'{wrt}_dot'
+        self._add_vector_variable(tangent, self.variables[wrt], 'dot')
+        self._add_product('jvp', fname, wrt, name, tangent)
+    
+    def add_vjp(self, fname, wrt, name, cotangent=None):
+        """Add a vector-Jacobian product (reverse-mode derivative) function.
+        
+        The function `name` takes the arguments of `fname` followed by the
+        cotangent, an array with the shape of the output of `fname`
+        registered as the variable `cotangent`, by default `{fname}_bar`.
+        It returns the derivative w.r.t. `wrt` contracted with the cotangent
+        over the output axes, with the shape of `wrt`. It is computed by
+        reverse accumulation over the subexpression DAG of `fname`, so the
+        cost of the generated code is a small multiple of that of `fname`,
+        independently of the size of `wrt`.
+        """
+        if cotangent is None:
+            cotangent = f'{fname}_bar'
+        output = self.default_function_output(fname)
+        spec = np.empty(output.shape, object)
+        for ind in np.ndindex(*output.shape):
+            spec[ind] = '_'.join([cotangent, *map(str, ind)])
+        self.variables[cotangent] = spec.tolist()
+        self._add_product('vjp', fname, wrt, name, cotangent)
+    
+    def add_hvp(self, fname, wrt, name, vector=None):
+        """Add a Hessian-vector product function of a scalar function.
+        
+        The function `name` takes the arguments of `fname` followed by the
+        vector, an array with the shape of the variable `wrt` registered as
+        the variable `vector`, by default `{wrt}_dot`. It returns the second
+        derivative of `fname` w.r.t. `wrt` contracted with the vector, with
+        the shape of `wrt`. It is computed by forward accumulation over the
+        reverse-mode gradient DAG, with the same cost properties as
+        `add_vjp`, so the Hessian is never materialized.
+        """
+        if vector is None:
+            vector = f'{wrt}_dot'
+        if vector not in self.variables:
+            self._add_vector_variable(vector, self.variables[wrt], 'dot')
+        self._add_product('hvp', fname, wrt, name, vector)
+    
+    def _add_product(self, kind, fname, wrt, name, vector):
+        """Add a lazily computed derivative product function."""
+        args = self.function_codegen_arguments(fname, include_self=True)
+        args[vector] = self.variables[vector]
+        compute = functools.partial(self._compute_product, name)
+        product = function.SymbolicSubsFunction(args, compute, lazy=True)
+        setattr(self, name, product)
+        self.products[name] = (kind, fname, wrt, vector)
+    
+    def _add_vector_variable(self, name, like, suffix):
+        """Add a variable with the shape of `like` and suffixed symbols."""
+        if not isinstance(like, var.SymbolArray):
+            raise TypeError("derivative products require array variables")
+        spec = np.empty(like.shape, object)
+        for ind, symbol in like.ndenumerate():
+            spec[ind] = f'{symbol.name}_{suffix}'
+        self.variables[name] = spec.tolist()
+    
+    def product_dag(self, name):
+        """Subexpression DAG and output of the derivative product `name`.
+        
+        The output references the symbols defined in the DAG, a sequence of
+        `(symbol, expr)` in topological order, which is empty for products
+        that are not computed by accumulation over the DAG.
+        """
+        try:
+            return self._product_dags[name]
+        except KeyError:
+            pass
+        
+        kind, fname, wrt, vector = self.products[name]
+        compute = getattr(self, f'_compute_{kind}')
+        self._product_dags[name] = compute(fname, wrt, vector)
+        return self._product_dags[name]
+    
+    def _compute_product(self, name):
+        subexpressions, output = self.product_dag(name)
+        return utils.ndexpr_expand(output, subexpressions)
+    
+    def _compute_jvp(self, fname, wrt, tangent):
+        subexpressions, output = self.codegen_output(fname)
+        with profiling.phase('differentiation', fname):
+            return utils.ndexpr_dag_jvp(output, self.variables[wrt],
+                                        self.variables[tangent],
+                                        subexpressions)
+    
+    def _compute_vjp(self, fname, wrt, cotangent):
+        output = self.default_function_output(fname)
+        with profiling.phase('differentiation', fname):
+            return utils.ndexpr_dag_vjp(output, self.variables[wrt],
+                                        self.variables[cotangent])
+    
+    def _compute_hvp(self, fname, wrt, vector):
+        output = self.default_function_output(fname)
+        if output.size != 1:
+            raise ValueError("Hessian-vector products require scalar functions")
+        wrt = self.variables[wrt]
+        with profiling.phase('differentiation', fname):
+            dag, grad = utils.ndexpr_dag_vjp(output, wrt, np.ones_like(output))
+            return utils.ndexpr_dag_jvp(grad, wrt, self.variables[vector], dag)
+    
+    def derivative_dag(self, fname, wrt):
+        """Subexpression DAG and output of a derivative of `fname`.
+        
+        The derivative w.r.t. the tuple of variables `wrt` is computed by
+        `utils.ndexpr_dag_diff`, extending the DAG of the lower order
+        derivative, so that the generated code of higher order derivatives
+        grows linearly instead of exponentially with the order.
+        """
+        if wrt == ():
+            return self.codegen_output(fname)
+        
+        key = (fname,) + wrt
+        try:
+            return self._derivative_dags[key]
+        except KeyError:
+            pass
+        
+        subexpressions, expr = self.derivative_dag(fname, wrt[1:])
+        wrt_array = self.variables[wrt[0]]
+        with profiling.phase('differentiation', fname):
+            subexpressions, deriv = utils.ndexpr_dag_diff(
+                expr, wrt_array, subexpressions
+            )
+        
+        # Use the same element for the permutations of the indices of
+        # repeated differentiation, so that they are deduplicated
+        run = next((k for k, v in enumerate(wrt) if v != wrt[0]), len(wrt))
+        if run > 1:
+            deriv = _symmetrize(deriv, run, wrt_array.ndim)
+        self._derivative_dags[key] = subexpressions, deriv
+        return subexpressions, deriv
+    
+    def codegen_output(self, fname):
+        """Output of `fname` for code generation and its subexpression DAG.
+        
+        Returns `(subexpressions, output)`, where the subexpressions are the
+        DAG of the derivatives and derivative products, shared by all
+        elements of the output in the generated code, and are empty for the
+        other functions.
+        """
+        if fname in self.products:
+            return self.product_dag(fname)
+        for key, dname in self.derivatives.items():
+            if dname == fname:
+                return self.derivative_dag(key[0], key[1:])
+        return [], self.default_function_output(fname)
+    
+    def dependencies(self, node):
+        """Nodes of the dependency graph on which `node` directly depends.
+        
+        The nodes are `('variable', name)` for the model variables,
+        `('function', name)` for the model functions, including the
+        registered derivatives and products, `('attribute', name)` for the
+        other instance attributes and `('global', module, name)` for the
+        module-level python functions called by the model functions. The
+        derivatives and products depend on the differentiated function and
+        variables and the model functions on
+        the variables of their arguments and on the functions and attributes
+        referenced by their code.
+        """
+        kind, *key = node
+        if kind in ('variable', 'attribute'):
+            return []
+        elif kind == 'global':
+            f = _global_function(*key)
+            return [('global', f.__module__, n)
+                    for n in _referenced_globals(f)]
+        
+        fname, = key
+        if fname in self.products:
+            kind, base, *variables = self.products[fname]
+            return [('function', base),
+                    *(('variable', v) for v in variables)]
+        for (base, *wrt), dname in self.derivatives.items():
+            if dname == fname:
+                return [('function', base),
+                        *(('variable', v) for v in wrt)]
+        
+        arguments = self.function_codegen_arguments(fname, include_self=True)
+        deps = [('variable', argname) for argname in arguments]
+        f = getattr(type(self), fname, None)
+        if not inspect.isfunction(inspect.unwrap(f)):
+            return deps
+        
+        names = sorted(_code_names(inspect.unwrap(f).__code__))
+        for n in names:
+            if (inspect.isfunction(getattr(type(self), n, None))
+                or n in self.derivatives.values() or n in self.products):
+                deps.append(('function', n))
+            elif n in vars(self) and not callable(vars(self)[n]):
+                deps.append(('attribute', n))
+        deps.extend(('global', f.__module__, n)
+                    for n in _referenced_globals(f))
+        return deps
+    
+    def dependency_graph(self, fnames):
+        """Dependency graph of the model functions `fnames`.
+        
+        Returns a dict mapping each node on which the functions depend,
+        directly or indirectly, to the list of its direct dependencies.
+        """
+        graph = {}
+        pending = [('function', fname) for fname in fnames]
+        while pending:
+            node = pending.pop()
+            if node not in graph:
+                graph[node] = self.dependencies(node)
+                pending.extend(graph[node])
+        return graph
+    
+    def fingerprint(self, fname):
+        """Digest of the inputs which determine the output of `fname`.
+        
+        Combines the source code of the functions, the specification of the
+        variables and the values of the attributes in the dependency graph
+        of `fname`, without any symbolic computation, so that it changes
+        when any of them is edited. Changes to objects outside the graph,
+        such as module constants or imported functions, are not detected.
+        """
+        graph = self.dependency_graph([fname])
+        fingerprints = {}
+        def node_fingerprint(node):
+            if node in fingerprints:
+                return fingerprints[node]
+            fingerprints[node] = None # Breaks dependency cycles
+            kind, *key = node
+            if kind == 'variable':
+                contents = self.variables[key[0]]
+            elif kind == 'attribute':
+                contents = vars(self)[key[0]]
+            elif kind == 'global':
+                contents = _source(_global_function(*key))
+            elif key[0] in self.derivatives.values():
+                contents = 'derivative'
+            elif key[0] in self.products:
+                contents = self.products[key[0]][0]
+            else:
+                f = getattr(type(self), key[0], None)
+                if inspect.isfunction(inspect.unwrap(f)):
+                    contents = _source(f)
+                else:
+                    contents = self.default_function_output(key[0])
+            deps = [(dep, node_fingerprint(dep)) for dep in graph[node]]
+            fingerprints[node] = codecache.digest(node, contents, deps)
+            return fingerprints[node]
+        return node_fingerprint(('function', fname))
+    
     def set_default_members(self):
         for key, val in self.variables['self'].items():
             setattr(self, key, val)
@@ -119,7 +390,8 @@ class Base:
                 return f.func.default_output
         
         args = self.function_codegen_arguments(fname)
-        with self.using_default_members():
+        with self.using_default_members(), \
+             profiling.phase('default_output', fname):
             return np.asarray(f(*args.values()))
 
     def print_code(self, **options):
@@ -131,6 +403,69 @@ class Base:
         return model_printer.class_obj()
 
 
+def method_sparsity(printer):
+    """Sparsity patterns of the functions of a method printer.
+    
+    Mapping of function names to the index lists, number and dense shape of
+    their structurally nonzero elements, in a form which can be stored in
+    the code cache.
+    """
+    if isinstance(printer, function.FusedFunctionPrinter):
+        printers = printer.members.items()
+    else:
+        printers = [(printer.name, printer)]
+    return {fname: (p.ind.tolist(), p.ind.shape[1], list(p.output.shape))
+            for fname, p in printers}
+
+
+def _symmetrize(deriv, order, ndim):
+    """Copy the canonical elements of a symmetric derivative to the others.
+    
+    The leading `order` groups of `ndim` axes of `deriv` are those of the
+    derivatives w.r.t. the same variable, and each element is replaced by
+    the one with the groups of indices in sorted order.
+    """
+    deriv = deriv.copy()
+    for ind in np.ndindex(*deriv.shape):
+        groups = sorted(ind[k*ndim:(k + 1)*ndim] for k in range(order))
+        deriv[ind] = deriv[sum(groups, ()) + ind[order*ndim:]]
+    return deriv
+
+
+def _code_names(code):
+    """Names used by a code object and its nested code objects."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names.update(_code_names(const))
+    return names
+
+
+def _global_function(module, name):
+    """Function `name` defined in the module named `module`."""
+    return vars(sys.modules[module])[name]
+
+
+def _referenced_globals(f):
+    """Names of the python functions of the module of `f` referenced by it."""
+    f = inspect.unwrap(f)
+    module = sys.modules.get(f.__module__)
+    if module is None or vars(module) is not f.__globals__:
+        return []
+    return sorted(n for n in _code_names(f.__code__)
+                  if inspect.isfunction(f.__globals__.get(n))
+                  and f.__globals__[n].__module__ == f.__module__)
+
+
+def _source(f):
+    """Source code of a function, or its marshalled code if unavailable."""
+    f = inspect.unwrap(f)
+    try:
+        return inspect.getsource(f)
+    except (OSError, TypeError):
+        return marshal.dumps(f.__code__).hex()
+
+
 def print_class(model, **options):
     model_printer = ModelPrinter(model, **options)
     return model_printer.print_class()
@@ -146,13 +481,20 @@ model_template_src = '''\
 import numpy as {{printer.numpy_alias}}
 {% for import in m.imports -%}
 import {{ import }}
+{% endfor -%}
+{% for statement in m.function_imports -%}
+{{ statement }}
 {% endfor %}
+{% for preamble in m.preambles %}
+{{ preamble }}
+
+{% endfor -%}
 class {{m.name}}({{ m.bases | join(', ') }}, metaclass={{m.metaclass}}):
     """Generated code for {{m.name}} from symbolic model."""
     {% for method in m.methods %}
     {{ method | indent }}
     {% endfor %}
-    {% for name, value in m.assignments.items() -%}
+    {% for name, value in m.class_assignments() -%}
     {% if isndarray(value) -%}
     {{ printer.print_ndarray(value, assign_to=name) }}
     {% else -%}
@@ -163,7 +505,16 @@ class {{m.name}}({{ m.bases | join(', ') }}, metaclass={{m.metaclass}}):
 
 
 class ModelPrinter:
-    """Generates numpy code for symbolic models."""
+    """Generates numpy code for symbolic models.
+    
+    With a code cache, the generated class is retrieved under its
+    `cache_key`. By default the key is a digest of the symbolic outputs of
+    all functions, so a warm start still computes them, including the
+    derivatives; only the printing and compilation are skipped. Skipping the
+    symbolic work as well requires the `cache_key` option or the
+    `incremental` mode, which key the code by user-given keys or by the
+    model fingerprints.
+    """
 
     @utils.cached_class_property
     def template(cls):
@@ -176,19 +527,40 @@ class ModelPrinter:
         self.options = options
         """Model printer options."""
         
+        self.profile = profiling.get_profile(options.get('profile'))
+        """Profile of the code generation phases, if enabled."""
+        
+        self._method_printers = {}
+        """Code printers of the generated methods created so far, by name."""
+    
+    @property
+    def functions(self):
+        """Names of the functions to generate code for."""
         try:
-            functions = options['functions']
+            return self.options['functions']
         except KeyError:
-            functions = getattr(model, 'generate_functions', [])
-                
+            return getattr(self.model, 'generate_functions', [])
+    
+    @utils.cached_property
+    @profiling.activates_profile
+    def _f_specs(self):
+        """Function generation specifications."""
         f_specs = []
-        for fname in functions:
-            output = self.model.default_function_output(fname)
+        for fname in self.functions:
+            subexpressions, output = self.model.codegen_output(fname)
             arguments = self.model.function_codegen_arguments(fname, True)
-            f_specs.append((fname, output, arguments))
+            f_specs.append((fname, subexpressions, output, arguments))
+        return f_specs
+    
+    @property
+    def function_specs(self):
+        """Generation specifications of the functions, except the fused.
         
-        self._f_specs = f_specs
-        """Function generation specifications."""
+        List of `(fname, subexpressions, output, arguments)` with the
+        subexpression DAG, symbolic output and code generation arguments of
+        each function, computed when first accessed.
+        """
+        return self._f_specs
     
     @property
     def name(self):
@@ -205,6 +577,207 @@ class ModelPrinter:
         except KeyError:
             return getattr(self.model, 'generate_assignments', {})
 
+    @property
+    def sparse(self):
+        """Names of the functions to generate in sparse mode."""
+        try:
+            return self.options['sparse']
+        except KeyError:
+            return getattr(self.model, 'generate_sparse', [])
+    
+    @property
+    def selectors(self):
+        """Output selectors of the functions generated in sparse mode.
+        
+        Mapping of function names to the `selector` option of their printers,
+        such as 'tril' to generate only the lower triangle of Hessians.
+        """
+        try:
+            return self.options['selectors']
+        except KeyError:
+            return getattr(self.model, 'generate_selectors', {})
+    
+    @property
+    def fused(self):
+        """Mapping of fused function names to the names of their members.
+        
+        Each fused function is generated as a single method which evaluates
+        all its members, computing their common subexpressions only once,
+        and returns the tuple of their outputs. Fused methods are always
+        generated with the numpy backend.
+        """
+        try:
+            return self.options['fused']
+        except KeyError:
+            return getattr(self.model, 'generate_fused', {})
+    
+    def _fused_spec(self, name):
+        """Generation specification of the fused function `name`."""
+        outputs = collections.OrderedDict()
+        arguments = function.Arguments()
+        for fname in self.fused[name]:
+            outputs[fname] = self.model.default_function_output(fname)
+            f_args = self.model.function_codegen_arguments(fname, True)
+            for argname, arg in f_args.items():
+                if argname not in arguments:
+                    arguments[argname] = arg
+        return name, outputs, arguments
+    
+    @utils.cached_property
+    @profiling.activates_profile
+    def _fused_specs(self):
+        """Fused function generation specifications."""
+        return [self._fused_spec(name) for name in self.fused]
+    
+    @property
+    def backend(self):
+        """Code generation backend of the generated methods."""
+        try:
+            return self.options['backend']
+        except KeyError:
+            return getattr(self.model, 'generate_backend', 'numpy')
+    
+    @property
+    def dtype(self):
+        """Numpy dtype of the generated methods, or None for the default.
+        
+        The outputs and floating-point arguments of the methods are of this
+        dtype, except for the methods listed in `accumulate`.
+        """
+        try:
+            return self.options['dtype']
+        except KeyError:
+            return getattr(self.model, 'generate_dtype', None)
+    
+    @property
+    def accumulate(self):
+        """Names of the functions evaluated in double precision.
+        
+        Allows mixed-precision models, in which functions such as sums or
+        cost functions are evaluated in float64 while the others are in the
+        lower precision of `dtype`. Fused functions are evaluated in float64
+        if any of their members is.
+        """
+        try:
+            return self.options['accumulate']
+        except KeyError:
+            return getattr(self.model, 'generate_accumulate', [])
+    
+    @property
+    def cse(self):
+        """Common subexpression elimination settings of the methods, or None.
+        
+        Passed as the `cse` option of the function printers, either a bool
+        or a dict of settings, if not None.
+        """
+        try:
+            return self.options['cse']
+        except KeyError:
+            return getattr(self.model, 'generate_cse', None)
+    
+    @property
+    def cse_stats(self):
+        """Common subexpression elimination statistics of each method."""
+        return {name: self.method_printer(name).cse_stats
+                for name in self.method_names}
+    
+    @property
+    def threads(self):
+        """Number of threads evaluating each generated method, or None.
+        
+        Passed as the `threads` option of the function printers, so that
+        the methods evaluate blocks of the broadcast elements concurrently.
+        The thread pool is shared by all methods. Fused methods are not
+        threaded.
+        """
+        try:
+            return self.options['threads']
+        except KeyError:
+            return getattr(self.model, 'generate_threads', None)
+    
+    @property
+    def layout(self):
+        """Memory layout of the arrays of the generated methods.
+        
+        Either 'batch_first', the default, or 'batch_last', in which the
+        broadcast dimensions of the arguments and outputs come last. The
+        conversion between both is done by `utils.to_batch_last` and
+        `utils.to_batch_first`.
+        """
+        try:
+            return self.options['layout']
+        except KeyError:
+            return getattr(self.model, 'generate_layout', 'batch_first')
+    
+    @property
+    def chunk(self):
+        """Chunk size of the generated methods, True for automatic, or None.
+        
+        In chunked mode the methods evaluate their outputs over blocks of at
+        most that many broadcast elements, bounding the memory of temporary
+        arrays. Fused methods are not chunked.
+        """
+        try:
+            return self.options['chunk']
+        except KeyError:
+            return getattr(self.model, 'generate_chunk', None)
+    
+    @property
+    def buffer_pool(self):
+        """Whether the generated methods reuse their output buffers.
+        
+        With buffer pooling, each instance of the generated class keeps one
+        output array per method and broadcast shape, which is returned by all
+        calls without an `out` argument. The returned arrays are therefore
+        overwritten by subsequent calls with the same broadcast shape.
+        """
+        try:
+            return self.options['buffer_pool']
+        except KeyError:
+            return getattr(self.model, 'generate_buffer_pool', False)
+    
+    @property
+    def sparsity_assignments(self):
+        """Class assignments of the sparsity patterns.
+        
+        For each sparse function and each function in `patterns`, `f`, the
+        indices of its nonzero elements are assigned to `f_ind`, their number
+        to `f_nnz` and its dense shape to `f_shape`. For matrices, the rows
+        and columns of the nonzero elements are then `f_ind[0]` and
+        `f_ind[1]`.
+        """
+        assigned = {*self.sparse, *self.patterns}
+        assignments = {}
+        for printed in self._printed_functions:
+            for fname, (ind, nnz, shape) in printed['sparsity'].items():
+                if fname not in assigned:
+                    continue
+                ind = np.array(ind, int).reshape(len(shape), nnz)
+                assignments[f'{fname}_ind'] = ind
+                assignments[f'{fname}_nnz'] = nnz
+                assignments[f'{fname}_shape'] = tuple(shape)
+        return assignments
+    
+    @property
+    def patterns(self):
+        """Names of the dense functions whose sparsity pattern is assigned.
+        
+        Defaults to all the registered derivatives of the model, so that the
+        structure of its Jacobians and Hessians is available to solvers
+        without evaluating them. The patterns of sparse functions are always
+        assigned.
+        """
+        try:
+            return self.options['patterns']
+        except KeyError:
+            default = list(self.model.derivatives.values())
+            return getattr(self.model, 'generate_patterns', default)
+    
+    def class_assignments(self):
+        """Iterator of all simple assignments made in the class code."""
+        yield from self.sparsity_assignments.items()
+        yield from self.assignments.items()
+
     @property
     def imports(self):
         """List of imports to include in the generated class code."""
@@ -229,20 +802,262 @@ class ModelPrinter:
         except KeyError:
             return getattr(self.model, 'generated_metaclass', 'type')
     
+    def function_options(self, fname):
+        """Code generation options of the function `fname`."""
+        options = {}
+        if fname in self.sparse:
+            options['sparse'] = True
+            if fname in self.selectors:
+                options['selector'] = self.selectors[fname]
+        if self.buffer_pool:
+            options['pool'] = True
+        if self.layout != 'batch_first':
+            options['layout'] = self.layout
+        if self.cse is not None:
+            options['cse'] = self.cse
+        members = self.fused.get(fname, [fname])
+        if any(m in self.accumulate for m in members):
+            options['dtype'] = 'float64'
+        elif self.dtype is not None:
+            options['dtype'] = self.dtype
+        if fname in self.fused:
+            members = self.fused[fname]
+            options['member_options'] = {
+                m: dict(sparse=True, selector=self.selectors.get(m))
+                for m in members if m in self.sparse
+            }
+            return options
+        if self.backend != 'numpy':
+            options['backend'] = self.backend
+        if self.chunk:
+            options['chunk'] = self.chunk
+        if self.threads:
+            options['threads'] = self.threads
+        return options
+    
+    @property
+    def incremental(self):
+        """Whether the generated code is cached by the model fingerprints.
+        
+        In incremental mode, the cache keys of the generated class and of
+        each of its methods are computed from `Base.fingerprint`, which
+        depends only on the code of the model, instead of the symbolic
+        expressions of the functions. After a change to the model, only the
+        methods which depend on the changed functions, variables or
+        attributes are then computed and printed again, and the code of the
+        others is retrieved from the cache.
+        """
+        try:
+            return self.options['incremental']
+        except KeyError:
+            return getattr(self.model, 'generate_incremental', False)
+    
+    @property
+    def method_names(self):
+        """Names of all the generated methods, plain and fused."""
+        return [*self.functions, *self.fused]
+    
+    @profiling.activates_profile
+    def method_printer(self, name):
+        """Code printer of the generated method `name`."""
+        try:
+            return self._method_printers[name]
+        except KeyError:
+            pass
+        
+        options = self.function_options(name)
+        if name in self.fused:
+            name, outputs, arguments = self._fused_spec(name)
+            printer = function.FusedFunctionPrinter(name, outputs, arguments,
+                                                    **options)
+        else:
+            subexpressions, output = self.model.codegen_output(name)
+            if subexpressions:
+                options['subexpressions'] = subexpressions
+            arguments = self.model.function_codegen_arguments(name, True)
+            printer = function.function_printer(name, output, arguments,
+                                                **options)
+        self._method_printers[name] = printer
+        return printer
+    
+    @property
+    def function_printers(self):
+        """Code printers of the generated functions."""
+        return [self.method_printer(fname) for fname in self.functions]
+    
+    @property
+    def fused_printers(self):
+        """Code printers of the generated fused functions."""
+        return [self.method_printer(name) for name in self.fused]
+    
+    def method_key(self, name):
+        """Digest of all inputs which determine the code of method `name`."""
+        if not self.incremental:
+            return self.method_printer(name).cache_key
+        
+        options = self.function_options(name)
+        if name in self.fused:
+            fingerprints = [self.model.fingerprint(fname)
+                            for fname in self.fused[name]]
+            template_src = function.fused_template_src
+        else:
+            fingerprints = [self.model.fingerprint(name)]
+            cls = function.function_printer_class(options.get('backend'))
+            template_src = cls.template_src
+        return codecache.digest('method', template_src, name, fingerprints,
+                                options)
+    
+    @property
+    def dump_dir(self):
+        """Directory to which the source of the generated class is dumped.
+        
+        If None, the source is compiled under a synthetic filename instead.
+        Either way it is registered in `linecache`, so that tracebacks and
+        profilers show the generated lines.
+        """
+        try:
+            return self.options['dump_dir']
+        except KeyError:
+            return getattr(self.model, 'generate_dump_dir', None)
+    
+    @property
+    def workers(self):
+        """Number of worker processes used to print the generated methods.
+        
+        If greater than one, or None for the number of CPUs, the methods are
+        printed in parallel by a process pool. The generated code is the same
+        as printed serially. Only the common subexpression elimination and
+        printing run in the workers: the symbolic outputs of the methods,
+        including the derivatives, are computed serially in this process, as
+        the model cannot be shipped to the workers.
+        """
+        try:
+            return self.options['workers']
+        except KeyError:
+            return getattr(self.model, 'generate_workers', 1)
+    
+    @utils.cached_property
+    @profiling.activates_profile
+    def _printed_functions(self):
+        """Printed code and sparsity pattern of each generated method.
+        
+        If a code cache is given, the code of each method is also cached
+        under its `method_key`, so that only the methods whose inputs changed
+        are printed again.
+        """
+        cache = codecache.get_cache(self.options.get('cache'))
+        printed = {}
+        if cache is not None:
+            keys = {name: self.method_key(name) for name in self.method_names}
+            for name, key in keys.items():
+                data = cache.load_data(key)
+                if data is not None:
+                    printed[name] = data
+        
+        missing = [name for name in self.method_names if name not in printed]
+        printers = [self.method_printer(name) for name in missing]
+        if self.workers == 1 or len(printers) < 2:
+            code = [(p.print_imports(), p.print_preamble(), p.print_def())
+                    for p in printers]
+        else:
+            from . import parallel
+            with profiling.phase('parallel_print', self.name):
+                code = parallel.print_functions(printers, self.workers)
+        
+        for name, printer, (imports, preamble, definition) in zip(
+                missing, printers, code):
+            printed[name] = dict(
+                imports=list(imports), preamble=preamble,
+                definition=definition, sparsity=method_sparsity(printer)
+            )
+            if cache is not None:
+                cache.store_data(keys[name], printed[name])
+        return [printed[name] for name in self.method_names]
+    
+    @property
+    def function_imports(self):
+        """Module-level imports required by the generated methods.
+        
+        Excludes the imports already made by the model template.
+        """
+        numpy_alias = printing.Printer().numpy_alias
+        made = {f'import numpy as {numpy_alias}'}
+        made.update(f'import {i}' for i in self.imports)
+        statements = []
+        for printed in self._printed_functions:
+            statements.extend(i for i in printed['imports'] if i not in made)
+        return list(dict.fromkeys(statements))
+    
+    @property
+    def preambles(self):
+        """Module-level code required by the generated methods.
+        
+        Identical preambles, such as the definition of a shared thread pool,
+        are included only once.
+        """
+        preambles = [printed['preamble'] for printed in self._printed_functions]
+        return [preamble for preamble in dict.fromkeys(preambles) if preamble]
+    
     @property
     def methods(self):
-        for fname, output, arguments in self._f_specs:
-            fdef = function.print_function(fname, output, arguments)
-            yield fdef
+        for printed in self._printed_functions:
+            yield printed['definition']
     
+    @profiling.activates_profile
     def print_class(self):
         isndarray = lambda var: isinstance(var, np.ndarray)
         context = dict(m=self, printer=printing.Printer(), isndarray=isndarray)
-        return self.template.render(context)
+        with profiling.phase('render_class', self.name):
+            return self.template.render(context)
 
+    @property
+    def cache_key(self):
+        """Digest of all inputs which determine the generated code.
+        
+        If the `cache_key` option is given, it is used instead of the
+        symbolic expressions of the functions, so that the generated class
+        can be retrieved from the cache without any symbolic computation. It
+        is then up to the user to change it when the model changes. In
+        `incremental` mode, the model fingerprints are used instead.
+        """
+        options = {k: v for k, v in self.options.items()
+                   if k not in ('cache', 'workers', 'profile', 'dump_dir')}
+        f_options = {}
+        for fname in self.functions:
+            f_opts = self.function_options(fname)
+            cls = function.function_printer_class(f_opts.get('backend'))
+            f_options[fname] = (f_opts, cls.template_src)
+        for name, members in self.fused.items():
+            f_opts = self.function_options(name)
+            f_options[name] = (members, f_opts, function.fused_template_src)
+        if 'cache_key' in options:
+            f_specs = None
+        elif self.incremental:
+            f_specs = [self.method_key(name) for name in self.method_names]
+        else:
+            f_specs = [(fname, subexpressions, output, list(arguments.items()))
+                       for fname, subexpressions, output, arguments
+                       in self._f_specs]
+            f_specs += [(name, outputs, list(arguments.items()))
+                        for name, outputs, arguments in self._fused_specs]
+        return codecache.digest(
+            'class', model_template_src, self.name, f_specs, self.assignments,
+            self.patterns, self.imports, self.bases, self.metaclass, f_options, options
+        )
+
+    @profiling.activates_profile
     def class_obj(self):
+        cache = codecache.get_cache(self.options.get('cache'))
+        if cache is not None:
+            with profiling.phase('cache_load', self.name):
+                return cache.load(self.cache_key, self.name, self.print_class)
+        
+        source = self.print_class()
+        with profiling.phase('compile', self.name):
+            code = codecache.compile_source(source, self.name, self.dump_dir)
         env = {}
-        exec(compile(self.print_class(), '<string>', 'exec'), env)
+        with profiling.phase('exec', self.name):
+            exec(code, env)
         return env[self.name]
 
 
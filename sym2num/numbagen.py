@@ -0,0 +1,116 @@
+"""Numba backend for symbolic array function code generation.
+
+The generated function checks and unpacks its arguments like the numpy
+backend, but all output elements are computed by a single compiled kernel
+which loops over the flattened broadcast dimensions in parallel. Each batch
+element is evaluated with scalar arithmetic, without array temporaries.
+Custom callables are not supported, as they cannot be called from nopython
+mode.
+"""
+
+
+from . import function, printing, profiling, utils
+
+
+kernel_template_src = '''\
+@numba.njit(parallel=True, nogil=True)
+def {{f.kernel_name}}({% for s in kernel_symbols %}_in{{loop.index0}}, {% endfor %}_out):
+    """Numba kernel of the generated function `{{f.name}}`."""
+    for _i in numba.prange(_out.shape[{{f.kernel_batch_axis}}]):
+        {%- for symbol in kernel_symbols %}
+        {{symbol}} = _in{{loop.index0}}[_i]
+        {%- endfor %}
+        {%- for cse_symbol, cse_code in cse_subs %}
+        {{cse_symbol}} = {{cse_code}}
+        {%- endfor %}
+        {%- for ind, expr in kernel_code %}
+        _out[{{f.kernel_index(ind)}}] = {{expr}}
+        {%- endfor %}
+        {%- for ind, src in f.duplicates %}
+        _out[{{f.kernel_index(ind)}}] = _out[{{f.kernel_index(src)}}]
+        {%- endfor %}
+'''
+
+
+numba_template_src = (
+    function.function_header_src
+    + function.arguments_template_src
+    + function.output_template_src
+    + '''\
+    # Evaluate the kernel over the flattened broadcast dimensions
+    {% if f.batch_last -%}
+    _batch_shape = _out_shape[{{f.out_shape | length}}:]
+    _flat_out = _out.reshape({{f.out_shape}} + (-1,))
+    {% else -%}
+    _batch_shape = _out_shape[:len(_out_shape) - {{f.out_shape | length}}]
+    _flat_out = _out.reshape((-1,) + {{f.out_shape}})
+    {% endif -%}
+    {{f.kernel_name}}(
+        {%- for symbol in kernel_symbols %}
+        {{np}}.broadcast_to({{symbol}}, _batch_shape).ravel(),
+        {%- endfor %}
+        _flat_out
+    )
+    if not {{np}}.may_share_memory(_flat_out, _out):
+        _out[...] = _flat_out.reshape(_out_shape)
+    return _out
+''')
+
+
+class NumbaFunctionPrinter(function.KernelFunctionPrinter):
+    """Generates numba-accelerated code for symbolic array functions."""
+
+    template_src = numba_template_src
+    """Source of the function definition template."""
+
+    kernel_template_src = kernel_template_src
+    """Source of the numba kernel template."""
+
+    def __init__(self, name, output, arguments, **options):
+        super().__init__(name, output, arguments, **options)
+
+        if self.threads:
+            msg = "numba kernels are parallelized by numba, not threads"
+            raise ValueError(msg)
+        
+        if self.referenced_callables:
+            callables = ', '.join(sorted(self.referenced_callables))
+            msg = f"custom callables `{callables}` not supported by numba"
+            raise ValueError(msg)
+
+    @property
+    def kernel_batch_axis(self):
+        """Axis of the flattened broadcast dimensions of the kernel output."""
+        return -1 if self.batch_last else 0
+    
+    def kernel_index(self, ind):
+        """Code indexing an output element of a kernel iteration."""
+        ind = [*ind, '_i'] if self.batch_last else ['_i', *ind]
+        return ', '.join(str(i) for i in ind)
+
+    def template_context(self, printer):
+        """Context for rendering the code templates."""
+        context = super().template_context(printer)
+        context.update(kernel_code=list(self.kernel_code(printer)))
+        return context
+
+    @utils.cached_property
+    @profiling.activates_profile
+    def _printed_kernel(self):
+        """Import statements and code of the numba kernel."""
+        printer = printing.Printer(float_dtype=self.dtype)
+        with profiling.phase('print', self.kernel_name):
+            context = self.template_context(printer)
+        with profiling.phase('render', self.kernel_name):
+            kernel = self.kernel_template.render(context)
+        return printer.import_statements(), kernel
+    
+    def print_imports(self):
+        """List of the module-level imports required by the generated code."""
+        kernel_imports = self._printed_kernel[0]
+        imports = [*super().print_imports(), 'import numba', *kernel_imports]
+        return list(dict.fromkeys(imports))
+    
+    def print_preamble(self):
+        """Print the module-level code required by the function definition."""
+        return self._printed_kernel[1]
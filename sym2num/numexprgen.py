@@ -0,0 +1,122 @@
+"""Numexpr backend for symbolic array function code generation.
+
+The generated function is like the one of the numpy backend, but each output
+element and common subexpression is evaluated by `numexpr.evaluate`, which
+compiles it to a multithreaded, cache-blocked virtual machine program. The
+expressions with functions not supported by numexpr, such as custom callables
+or `getmaskarray`, fall back to numpy code.
+"""
+
+
+import math
+
+from . import function, printing
+
+
+class NumexprUnsupported(Exception):
+    """Expression cannot be evaluated by numexpr."""
+
+
+class NumexprStringPrinter(printing.Printer):
+    """Printer of expressions in the numexpr syntax."""
+
+    functions = {
+        'numpy.sin': 'sin',
+        'numpy.cos': 'cos',
+        'numpy.tan': 'tan',
+        'numpy.arcsin': 'arcsin',
+        'numpy.arccos': 'arccos',
+        'numpy.arctan': 'arctan',
+        'numpy.arctan2': 'arctan2',
+        'numpy.sinh': 'sinh',
+        'numpy.cosh': 'cosh',
+        'numpy.tanh': 'tanh',
+        'numpy.arcsinh': 'arcsinh',
+        'numpy.arccosh': 'arccosh',
+        'numpy.arctanh': 'arctanh',
+        'numpy.exp': 'exp',
+        'numpy.expm1': 'expm1',
+        'numpy.log': 'log',
+        'numpy.log10': 'log10',
+        'numpy.log1p': 'log1p',
+        'numpy.sqrt': 'sqrt',
+        'numpy.real': 'real',
+        'numpy.imag': 'imag',
+        'abs': 'abs',
+    }
+    """Numexpr names of the supported numpy functions."""
+
+    constants = {
+        'numpy.e': repr(math.e),
+        'numpy.pi': repr(math.pi),
+        'scipy.constants.pi': repr(math.pi),
+    }
+    """Numexpr literals of the supported numpy and scipy constants."""
+
+    def __init__(self, settings=None, float_dtype=None):
+        super().__init__(settings, float_dtype)
+        
+        self.float_constants = {}
+        """Names of the non-integer constants, if the `float_dtype` is set.
+        
+        Numexpr evaluates the literals in double precision, so constants of
+        other dtypes are passed to it as variables instead.
+        """
+    
+    def _print(self, e):
+        if self.float_dtype is not None and printing.is_float_constant(e):
+            default = f'_k{len(self.float_constants)}'
+            return self.float_constants.setdefault(e, default)
+        return super()._print(e)
+    
+    def _module_format(self, fqn, register=True):
+        try:
+            return self.functions.get(fqn) or self.constants[fqn]
+        except KeyError:
+            raise NumexprUnsupported(fqn) from None
+
+    def _print_CallableBase(self, e):
+        raise NumexprUnsupported(e.func)
+
+    def _print_getmaskarray(self, e):
+        raise NumexprUnsupported(e.func)
+
+    def _print_not_supported(self, e):
+        raise NumexprUnsupported(type(e))
+
+
+class NumexprPrinter(printing.Printer):
+    """sym2num printer of expressions as `numexpr.evaluate` calls."""
+
+    import_aliases = dict(printing.Printer.import_aliases, numexpr='_ne')
+
+    def doprint(self, expr, assign_to=None):
+        if assign_to is None and expr.free_symbols:
+            string_printer = NumexprStringPrinter(float_dtype=self.float_dtype)
+            try:
+                code = string_printer.doprint(expr)
+            except NumexprUnsupported:
+                pass
+            else:
+                evaluate = self._module_format('numexpr.evaluate')
+                if not string_printer.float_constants:
+                    return f"{evaluate}('{code}')"
+                
+                # Pass the constants of the float dtype as variables
+                symbols = sorted(expr.free_symbols, key=lambda s: s.name)
+                names = [self._print(s) for s in symbols]
+                local_dict = [f"'{n}': {n}" for n in names]
+                local_dict += [
+                    f"'{name}': {self._print(constant)}"
+                    for constant, name in string_printer.float_constants.items()
+                ]
+                local_dict = ', '.join(local_dict)
+                return f"{evaluate}('{code}', local_dict={{{local_dict}}})"
+        return super().doprint(expr, assign_to)
+
+
+class NumexprFunctionPrinter(function.FunctionPrinter):
+    """Generates numexpr-accelerated code for symbolic array functions."""
+
+    printer_class = NumexprPrinter
+    """Class of the printer of the output expressions."""
@@ -0,0 +1,188 @@
+"""Parallel printing of generated functions in worker processes.
+
+The function printers are shipped to the workers as portable specifications,
+with the symbolic expressions serialized by `sympy.srepr` and the variables
+by their specifications, as the code generation callables are dynamically
+created classes which cannot be pickled. The workers return the printed code,
+which is then assembled in the parent process in the original order, so that
+the result is identical to printing serially. The workers run the common
+subexpression elimination and printing of the given outputs; computing the
+outputs, such as the differentiation of model functions, is up to the caller.
+
+The workers are spawned as fresh interpreters rather than forked, as forking
+a process with running threads, such as those of the numba runtime, can
+deadlock. Scripts which generate code in parallel must therefore guard their
+main code with `if __name__ == '__main__'`.
+"""
+
+
+import concurrent.futures
+import importlib
+import multiprocessing
+
+import numpy as np
+import sympy
+
+from . import function, metafun, var
+
+
+def dump_variable(variable):
+    """Portable specification of a code generation variable."""
+    if isinstance(variable, var.SymbolArray):
+        symbols = dump_ndexpr(np.asarray(variable, object))
+        return 'array', symbols, variable.gen_dtype
+    elif isinstance(variable, var.SymbolObject):
+        items = [(k, dump_variable(v)) for k, v in variable.items()]
+        return 'object', type(variable), items
+    elif isinstance(variable, var.CallableMeta):
+        if issubclass(variable, var.BivariateCallableBase):
+            return 'bivariate', variable.name
+        else:
+            return 'univariate', variable.name
+    else:
+        raise TypeError(f"unrecognized variable type {type(variable)}")
+
+
+def dump_ndexpr(ndexpr):
+    """Portable specification of an array of expressions."""
+    ndexpr = np.asarray(ndexpr, object)
+    return ndexpr.shape, [sympy.srepr(e) for e in ndexpr.flat]
+
+
+def dump_functions(exprs):
+    """Qualified names of the classes of the non-sympy functions in `exprs`.
+    
+    The code generation callables are excluded, as they are rebuilt from the
+    specifications of the arguments.
+    """
+    functions = set()
+    for expr in exprs:
+        for applied in sympy.sympify(expr).atoms(sympy.Function):
+            cls = type(applied)
+            if (cls.__module__.split('.')[0] == 'sympy'
+                    or isinstance(cls, var.CallableMeta)
+                    or isinstance(cls, sympy.core.function.UndefinedFunction)):
+                continue
+            functions.add((cls.__module__, cls.__qualname__))
+    return sorted(functions)
+
+
+class Loader:
+    """Rebuilds the expressions and variables from their specifications."""
+
+    def __init__(self):
+        self.namespace = {}
+        """Namespace for evaluating `srepr` strings."""
+        exec('from sympy import *', self.namespace)
+        self.namespace.update(
+            getmaskarray=metafun.getmaskarray, invert=metafun.invert
+        )
+
+    def function(self, module, qualname):
+        """Import a function class into the `srepr` namespace."""
+        obj = importlib.import_module(module)
+        for attr in qualname.split('.'):
+            obj = getattr(obj, attr)
+        self.namespace[obj.__name__] = obj
+
+    def variable(self, spec):
+        """Rebuild a code generation variable from its specification."""
+        kind = spec[0]
+        if kind == 'array':
+            symbols, gen_dtype = spec[1:]
+            return var.SymbolArray(self.ndexpr(symbols), gen_dtype)
+        elif kind == 'object':
+            cls, items = spec[1:]
+            return cls((k, self.variable(v)) for k, v in items)
+        elif kind in ('univariate', 'bivariate'):
+            name = spec[1]
+            callable_cls = self.namespace.get(name)
+            if not isinstance(callable_cls, var.CallableMeta):
+                if kind == 'univariate':
+                    callable_cls = var.UnivariateCallable(name)
+                else:
+                    callable_cls = var.BivariateCallable(name)
+                self.namespace[name] = callable_cls
+            return callable_cls
+        else:
+            raise ValueError(f"unrecognized variable specification {kind}")
+
+    def expr(self, srepr):
+        """Rebuild an expression from its `srepr` string."""
+        return eval(srepr, self.namespace)
+
+    def ndexpr(self, spec):
+        """Rebuild an array of expressions from its specification."""
+        shape, elements = spec
+        ndexpr = np.empty(len(elements), object)
+        for i, element in enumerate(elements):
+            ndexpr[i] = self.expr(element)
+        return ndexpr.reshape(shape)
+
+
+def dump_printer(printer):
+    """Portable specification of a function printer."""
+    arguments = [(k, dump_variable(v)) for k, v in printer.arguments.items()]
+    options = {k: v for k, v in printer.options.items() if k != 'profile'}
+    exprs = [e for s, e in options.get('subexpressions', [])]
+    if 'subexpressions' in options:
+        options['subexpressions'] = [
+            (sympy.srepr(s), sympy.srepr(e)) for s, e in options['subexpressions']
+        ]
+    if isinstance(printer, function.FusedFunctionPrinter):
+        members = printer.members.values()
+        outputs = [(k, dump_ndexpr(m.output))
+                   for k, m in printer.members.items()]
+        kind = 'fused'
+    else:
+        members = [printer]
+        outputs = dump_ndexpr(printer.output)
+        kind = 'function'
+    for m in members:
+        exprs.extend(m.output.flat)
+    functions = dump_functions(exprs)
+    return kind, printer.name, outputs, arguments, options, functions
+
+
+def load_printer(spec):
+    """Rebuild a function printer from its portable specification."""
+    kind, name, output, arguments, options, functions = spec
+    loader = Loader()
+    for module, qualname in functions:
+        loader.function(module, qualname)
+
+    # Load the arguments first, so that the callables are defined
+    arguments = function.Arguments(
+        (k, loader.variable(v)) for k, v in arguments
+    )
+    if 'subexpressions' in options:
+        options = dict(options)
+        options['subexpressions'] = [
+            (loader.expr(s), loader.expr(e)) for s, e in options['subexpressions']
+        ]
+    if kind == 'fused':
+        outputs = {k: loader.ndexpr(v) for k, v in output}
+        return function.FusedFunctionPrinter(name, outputs, arguments,
+                                             **options)
+    else:
+        output = loader.ndexpr(output)
+        return function.function_printer(name, output, arguments, **options)
+
+
+def print_printer_spec(spec):
+    """Print the imports, preamble and definition of a printer spec."""
+    p = load_printer(spec)
+    return p.print_imports(), p.print_preamble(), p.print_def()
+
+
+def print_functions(printers, workers=None):
+    """Print the code of functions in worker processes.
+
+    Returns a list of `(imports, preamble, definition)` for each printer, in
+    order, where `imports` is the list of the import statements.
+    The number of worker processes defaults to the number of CPUs.
+    """
+    specs = [dump_printer(p) for p in printers]
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(workers, context) as executor:
+        return list(executor.map(print_printer_spec, specs))
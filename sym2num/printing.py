@@ -22,6 +22,16 @@ class Printer(SciPyPrinter):
         'scipy.sparse': '_scipy_sparse'
     }
     
+    def __init__(self, settings=None, float_dtype=None):
+        super().__init__(settings)
+        
+        self.float_dtype = float_dtype
+        """Numpy dtype of the non-integer constants, or None for Python float.
+        
+        Python floats promote scalar single-precision operands to double, so
+        the constants are wrapped in the dtype to preserve the precision.
+        """
+    
     @property
     def numpy_alias(self):
         return self.import_aliases.get('numpy', 'numpy')
@@ -45,6 +55,17 @@ class Printer(SciPyPrinter):
         for module, alias in self.import_aliases.items():
             if module in self.module_imports:
                 yield module, alias
+    
+    def import_statements(self):
+        """List of the import statements required by the printed code."""
+        statements = [f'import numpy as {self.numpy_alias}']
+        for module in self.direct_imports:
+            if module != 'numpy':
+                statements.append(f'import {module}')
+        for module, alias in self.aliased_imports:
+            if module != 'numpy':
+                statements.append(f'import {module} as {alias}')
+        return statements
 
     def print_ndarray(self, arr, assign_to=None):
         arr = np.asarray(arr)
@@ -69,6 +90,9 @@ class Printer(SciPyPrinter):
         # names and standard functions like 'gamma' or 'exp'
         if isinstance(e, var.CallableBase):
             return self._print_CallableBase(e)
+        elif self.float_dtype is not None and is_float_constant(e):
+            dtype = self._module_format(f'numpy.{self.float_dtype}')
+            return f'{dtype}({super()._print(e)})'
         else:
             return super()._print(e)
     
@@ -85,3 +109,10 @@ class Printer(SciPyPrinter):
         arg = self._print(e.args[0])
         np = self.numpy_alias
         return f'{np}.ma.getmaskarray({arg})'
+
+
+def is_float_constant(expr):
+    """Whether an expression is a non-integer numeric constant."""
+    if isinstance(expr, sympy.Integer):
+        return False
+    return isinstance(expr, (sympy.Float, sympy.Rational, sympy.NumberSymbol))
@@ -0,0 +1,184 @@
+"""Profiling of the code generation pipeline.
+
+The code generation steps are instrumented with `phase` context managers,
+which record the wall time, number of calls and, optionally, the peak traced
+memory of each phase and generated function into the active profiles. The
+phases are no-ops when no profile is active.
+
+A profile can be activated around any code with the `profile` context
+manager, for example around the model construction and code generation to
+include the symbolic differentiation of the derivatives registered with
+`Base.add_derivative`, which is done on demand:
+
+>>> with profile() as p:
+...     with phase('example', 'f'):
+...         pass
+>>> [(r['phase'], r['function'], r['calls']) for r in p.report()]
+[('example', 'f', 1)]
+
+The `FunctionPrinter` and `ModelPrinter` accept a `profile` option, either
+True or a `Profile`, to activate it during their own work and make it
+available in their `profile` attribute.
+"""
+
+
+import collections
+import contextlib
+import functools
+import time
+import tracemalloc
+
+
+class PhaseStats:
+    """Statistics of a code generation phase."""
+
+    def __init__(self):
+        self.calls = 0
+        """Number of times the phase was run."""
+
+        self.time = 0.0
+        """Total wall time of the phase, in seconds."""
+
+        self.peak_memory = None
+        """Peak traced memory allocated during the phase, in bytes."""
+
+
+class Profile:
+    """Records of the code generation phases."""
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        """Whether to record the peak memory of the phases with tracemalloc."""
+
+        self.stats = collections.OrderedDict()
+        """Statistics of each `(phase, function)` in order of first run."""
+
+    def record(self, phase, function, elapsed, peak_memory=None):
+        """Add a run of a phase to the statistics."""
+        stats = self.stats.get((phase, function))
+        if stats is None:
+            stats = self.stats[phase, function] = PhaseStats()
+        stats.calls += 1
+        stats.time += elapsed
+        if peak_memory is not None:
+            stats.peak_memory = max(stats.peak_memory or 0, peak_memory)
+
+    def report(self):
+        """List of the statistics of each phase and function, as dicts."""
+        return [dict(phase=phase, function=function, calls=s.calls,
+                     time=s.time, peak_memory=s.peak_memory)
+                for (phase, function), s in self.stats.items()]
+
+    def summary(self):
+        """Total time and number of calls of each phase."""
+        summary = collections.OrderedDict()
+        for (phase, function), s in self.stats.items():
+            total = summary.setdefault(phase, dict(calls=0, time=0.0))
+            total['calls'] += s.calls
+            total['time'] += s.time
+        return summary
+
+    def __str__(self):
+        lines = [f'{"phase":<24} {"function":<24} {"calls":>6} '
+                 f'{"time [s]":>10} {"peak [MiB]":>10}']
+        for r in self.report():
+            peak = r['peak_memory']
+            peak = '' if peak is None else f'{peak / 2**20:.2f}'
+            lines.append(f'{r["phase"]:<24} {r["function"] or "":<24} '
+                         f'{r["calls"]:>6} {r["time"]:>10.4f} {peak:>10}')
+        return '\n'.join(lines)
+
+
+_active = []
+"""Stack of the active profiles."""
+
+
+_memory_frames = []
+"""Stack of the peak traced memory of the running phases."""
+
+
+def get_profile(spec):
+    """Get the profile from a code generation option.
+
+    >>> get_profile(None) is None
+    True
+    >>> p = Profile()
+    >>> get_profile(p) is p
+    True
+
+    """
+    if spec is None or spec is False:
+        return None
+    elif spec is True:
+        return Profile()
+    elif isinstance(spec, Profile):
+        return spec
+    else:
+        raise TypeError("unrecognized profile specification")
+
+
+@contextlib.contextmanager
+def profile(p=None, memory=False):
+    """Context manager activating a profile, created if None."""
+    if p is None:
+        p = Profile(memory)
+    start_tracing = p.memory and not tracemalloc.is_tracing()
+    if start_tracing:
+        tracemalloc.start()
+    _active.append(p)
+    try:
+        yield p
+    finally:
+        _active.remove(p)
+        if start_tracing:
+            tracemalloc.stop()
+
+
+def activated(p):
+    """Context manager activating a profile, or doing nothing if None."""
+    if p is None or p in _active:
+        return contextlib.nullcontext(p)
+    return profile(p)
+
+
+def activates_profile(method):
+    """Decorator of methods which activate the profile of their object."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with activated(self.profile):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def phase(name, function=None):
+    """Context manager recording a phase in the active profiles."""
+    if not _active:
+        yield
+        return
+
+    memory = any(p.memory for p in _active) and tracemalloc.is_tracing()
+    if memory:
+        # The peak of the enclosing phase is saved before resetting it
+        current, peak = tracemalloc.get_traced_memory()
+        if _memory_frames:
+            _memory_frames[-1] = max(_memory_frames[-1], peak)
+        tracemalloc.reset_peak()
+        _memory_frames.append(current)
+        start_memory = current
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        peak_memory = None
+        if memory:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            peak = max(_memory_frames.pop(), traced_peak)
+            peak_memory = peak - start_memory
+            if _memory_frames:
+                _memory_frames[-1] = max(_memory_frames[-1], peak)
+        for p in _active:
+            p_peak_memory = peak_memory if p.memory else None
+            p.record(name, function, elapsed, p_peak_memory)
@@ -0,0 +1,144 @@
+'''Model derivative generation test.'''
+
+
+import numpy as np
+import pytest
+import sympy
+
+from sym2num import model, utils
+
+
+class DerivativeModel(model.Base):
+    '''Model for testing the derivative generation.'''
+
+    generate_functions = ['f', 'df_dx', 'f_jvp', 'f_vjp', 'g', 'd2g_dx2',
+                          'g_hvp']
+
+    def __init__(self):
+        super().__init__()
+        self.variables['a'] = 'a'
+        self.variables['x'] = ['x1', 'x2', 'x3']
+        self.add_derivative('f', 'x', 'df_dx')
+        self.add_jvp('f', 'x', 'f_jvp')
+        self.add_vjp('f', 'x', 'f_vjp')
+        self.add_derivative('g', ('x', 'x'), 'd2g_dx2')
+        self.add_hvp('g', 'x', 'g_hvp')
+
+    @model.collect_symbols
+    def f(self, a, x, *, s):
+        return [s.a * s.x1 ** 2 * s.x2, sympy.sin(s.x2 * s.x3), s.x1]
+
+    @model.collect_symbols
+    def g(self, a, x, *, s):
+        return s.a * s.x1 ** 2 * s.x2 + s.x1 * sympy.exp(s.x2 * s.x3)
+
+
+@pytest.fixture(scope='module')
+def generated():
+    '''Instance of the generated derivative model.'''
+    return DerivativeModel().compile_class()()
+
+
+def test_jvp(generated):
+    '''Test the Jacobian-vector product against the contracted Jacobian.'''
+    x = np.random.standard_normal((4, 3))
+    v = np.random.standard_normal((4, 3))
+    jac = generated.df_dx(2.0, x)
+    np.testing.assert_allclose(generated.f_jvp(2.0, x, v),
+                               np.einsum('...ij,...i', jac, v))
+    assert 'x_dot' in DerivativeModel().variables
+
+
+def test_vjp(generated):
+    '''Test the vector-Jacobian product against the contracted Jacobian.'''
+    x = np.random.standard_normal((4, 3))
+    w = np.random.standard_normal((4, 3))
+    jac = generated.df_dx(2.0, x)
+    np.testing.assert_allclose(generated.f_vjp(2.0, x, w),
+                               np.einsum('...ij,...j', jac, w))
+
+
+def test_scalar(generated):
+    '''Test the generated scalar function.'''
+    x = np.array([0.5, 2.0, -1.0])
+    expected = 2.0 * 0.5 ** 2 * 2.0 + 0.5 * np.exp(-2.0)
+    np.testing.assert_allclose(generated.g(2.0, x), expected)
+    assert generated.g(2.0, np.ones((4, 3))).shape == (4,)
+
+
+def test_hvp(generated):
+    '''Test the Hessian-vector product against the contracted Hessian.'''
+    x = np.random.standard_normal((4, 3))
+    v = np.random.standard_normal((4, 3))
+    hess = generated.d2g_dx2(2.0, x)
+    np.testing.assert_allclose(generated.g_hvp(2.0, x, v),
+                               np.einsum('...ij,...j', hess, v))
+
+
+def test_hvp_nonscalar():
+    '''Test that Hessian-vector products require scalar functions.'''
+    m = DerivativeModel()
+    m.add_hvp('f', 'x', 'f_hvp')
+    with pytest.raises(ValueError):
+        m.default_function_output('f_hvp')
+
+
+def test_patterns(generated):
+    '''Test the structural sparsity patterns of the derivatives.'''
+    assert generated.df_dx_shape == (3, 3)
+    assert generated.df_dx_nnz == generated.df_dx_ind.shape[1] == 5
+    assert not hasattr(generated, 'f_ind')
+
+    x = np.random.standard_normal(3)
+    jac = generated.df_dx(2.0, x)
+    mask = np.zeros(jac.shape, bool)
+    mask[tuple(generated.df_dx_ind)] = True
+    np.testing.assert_equal(jac[~mask], 0)
+    assert np.all(jac[mask] != 0)
+
+
+def test_derivative_dag():
+    '''Test that the derivatives are generated over a shared DAG.'''
+    m = DerivativeModel()
+    dag, d2g = m.codegen_output('d2g_dx2')
+    grad_dag, grad = m.derivative_dag('g', ('x',))
+    assert dag[:len(grad_dag)] == grad_dag
+    assert d2g[0, 1] == d2g[1, 0]
+    
+    expected = m.default_function_output('d2g_dx2')
+    expanded = utils.ndexpr_expand(d2g, dag)
+    assert all(sympy.simplify(a - b) == 0
+               for a, b in zip(expanded.flat, expected.flat))
+
+
+class DenseModel(model.Base):
+    '''Model with a densely coupled output for testing the product sizes.'''
+
+    generate_functions = ['g', 'g_jvp']
+
+    def __init__(self, n):
+        super().__init__()
+        self.variables['x'] = [f'x{i}' for i in range(n)]
+        self.add_jvp('g', 'x', 'g_jvp')
+
+    @model.collect_symbols
+    def g(self, x, *, s):
+        x = [s[f'x{i}'] for i in range(len(self.variables['x']))]
+        return [xi * sum(x) + sympy.cos(xi) for xi in x]
+
+
+def test_jvp_dag():
+    '''Test that the Jacobian-vector product grows linearly with the size.'''
+    def product_ops(n):
+        dag, jvp = DenseModel(n).product_dag('g_jvp')
+        return sympy.count_ops([e for s, e in dag] + list(jvp.flat))
+    assert product_ops(30) < 4 * product_ops(10)
+    
+    m = DenseModel(4)
+    jac = sympy.derive_by_array(m.default_function_output('g'),
+                                m.variables['x'])
+    v = m.variables['x_dot']
+    expected = np.einsum('ij,i', np.array(jac.tolist()), np.array(v.tolist()))
+    expanded = m.default_function_output('g_jvp')
+    assert all(sympy.expand(a - b) == 0
+               for a, b in zip(expanded.flat, expected.flat))
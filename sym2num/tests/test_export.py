@@ -0,0 +1,43 @@
+'''Model export test.'''
+
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+import sympy
+
+from sym2num import export, model
+
+
+class ExportModel(model.Base):
+    '''Simple model for testing the export.'''
+
+    generate_functions = ['f', 'df_dx']
+
+    def __init__(self):
+        super().__init__()
+        self.variables['x'] = ['x1', 'x2']
+        self.add_derivative('f', 'x', 'df_dx')
+
+    def f(self, x):
+        return [x[0] * sympy.sin(x[1]), x[1] ** 2]
+
+
+def test_export(tmp_path):
+    '''Test that the exported package is imported without sympy.'''
+    path = tmp_path / 'exported'
+    manifest = export.export_models([ExportModel()], path)
+    assert manifest == export.read_manifest(path)
+    assert set(manifest['generated_export_model']['functions']) == {
+        'f', 'df_dx'
+    }
+    assert os.listdir(path / '__pycache__')
+
+    code = ('import sys, exported; '
+            'm = exported.GeneratedExportModel(); '
+            'print(m.f([1.0, 2.0]).tolist(), "sympy" in sys.modules)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=tmp_path,
+                            capture_output=True, text=True, check=True)
+    assert result.stdout.split() == [f'[{np.sin(2.0)},', '4.0]', 'False']
@@ -0,0 +1,451 @@
+'''Function code generation test.'''
+
+
+import inspect
+import linecache
+import os
+import shutil
+import tracemalloc
+
+import numpy as np
+import pytest
+import sympy
+
+from sym2num import codecache, function, parallel, profiling, utils, var
+from sym2num.metafun import getmaskarray
+
+
+@pytest.fixture
+def spec():
+    '''Symbolic function specification.'''
+    t, x1, x2 = sympy.symbols('t, x1, x2')
+    output = [[sympy.sin(x1) * t, 0], [x1 * x2, sympy.exp(x2) + x1**2]]
+    arguments = function.Arguments(t=t, x=[x1, x2])
+    return output, arguments
+
+
+def test_compile(spec):
+    '''Test the generated function against its symbolic expression.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments)
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    expected = [[np.sin(x[:, 0]) * t, np.zeros(4)],
+                [x[:, 0] * x[:, 1], np.exp(x[:, 1]) + x[:, 0] ** 2]]
+    np.testing.assert_allclose(f(t, x), np.moveaxis(expected, -1, 0))
+
+
+def test_scalar_output(spec):
+    '''Test functions with scalar outputs and without arguments.'''
+    output, arguments = spec
+    t, x1, x2 = sympy.symbols('t, x1, x2')
+    f = function.compile_function('f', x1 * x2, arguments)
+    assert f(1.0, [2.0, 3.0]) == 6.0
+    np.testing.assert_equal(f(1.0, [[2.0, 3.0], [1.0, 2.0]]), [6.0, 2.0])
+    
+    out = np.ones(())
+    zero = function.compile_function('zero', sympy.S.Zero, arguments)
+    assert zero(1.0, [2.0, 3.0], out=out) is out
+    assert out == 0
+    
+    g = function.compile_function('g', [1, 2], function.Arguments())
+    np.testing.assert_equal(g(), [1.0, 2.0])
+    
+    outputs = dict(f=x1 * x2, g=[x1, t])
+    fused = function.FusedFunctionPrinter('fg', outputs, arguments).callable()
+    f_value, g_value = fused(1.0, [2.0, 3.0])
+    assert f_value == 6.0
+    np.testing.assert_equal(g_value, [2.0, 1.0])
+
+
+def test_hoisted_imports(spec):
+    '''Test that the imports are made at module level only.'''
+    output, arguments = spec
+    printer = function.FunctionPrinter('f', output, arguments)
+    assert 'import' not in printer.print_def()
+    assert printer.print_code().startswith('import numpy as _np\n')
+
+
+def test_linecache(spec, tmp_path):
+    '''Test that the generated source is registered for tracebacks.'''
+    output, arguments = spec
+    printer = function.FunctionPrinter('f', output, arguments)
+    code = inspect.unwrap(printer.callable()).__code__
+    assert code.co_filename.startswith('<sym2num-f-')
+    lines = printer.print_code().splitlines()
+    assert linecache.getline(code.co_filename, 1).rstrip() == lines[0]
+    
+    f = function.compile_function('f', output, arguments, dump_dir=tmp_path)
+    filename = inspect.unwrap(f).__code__.co_filename
+    with open(filename) as source_file:
+        assert source_file.read() == printer.print_code()
+
+
+def test_code_cache(spec, tmp_path):
+    '''Test the generated code cache hits and misses.'''
+    output, arguments = spec
+    cache = codecache.CodeCache(tmp_path)
+    f = function.compile_function('f', output, arguments, cache=cache)
+    function.compile_function('f', output, arguments, cache=cache)
+    assert cache.cache_info()[:3] == (1, 0, 1)
+
+    # A new cache with the same directory is warm
+    cache = codecache.CodeCache(tmp_path)
+    h = function.compile_function('f', output, arguments, cache=cache)
+    assert cache.cache_info()[:3] == (0, 1, 0)
+
+    # Different options are a different key
+    function.compile_function('f', output, arguments, cache=cache, foo=1)
+    assert cache.cache_info()[:3] == (0, 1, 1)
+
+    x = np.random.standard_normal(2)
+    np.testing.assert_equal(f(1, x), h(1, x))
+
+
+def test_cache_key_callables(spec):
+    '''Test that callable options are keyed by name or rejected.'''
+    output, arguments = spec
+    printer = function.FunctionPrinter('f', output, arguments, sparse=True,
+                                       selector=utils.istril)
+    assert 'sym2num.utils.istril' in codecache.key_repr(printer.options)
+    lambda_printer = function.FunctionPrinter(
+        'f', output, arguments, sparse=True, selector=lambda i, j: i >= j
+    )
+    with pytest.raises(TypeError):
+        lambda_printer.cache_key
+
+
+def test_template_src_override(spec):
+    '''Test that subclasses render their own template source.'''
+    output, arguments = spec
+
+    class CommentedPrinter(function.FunctionPrinter):
+        template_src = '# commented\n' + function.function_template_src
+
+    function.FunctionPrinter.template
+    base = function.FunctionPrinter('f', output, arguments)
+    commented = CommentedPrinter('f', output, arguments)
+    assert commented.print_def().startswith('# commented\n')
+    assert not base.print_def().startswith('# commented')
+
+
+def test_profile(spec):
+    '''Test the profiling report of the code generation phases.'''
+    output, arguments = spec
+    printer = function.FunctionPrinter('f', output, arguments, profile=True)
+    with profiling.profile(memory=True) as outer:
+        printer.callable()
+    phases = [r['phase'] for r in printer.profile.report()]
+    assert phases == ['sympify', 'cse', 'print', 'render', 'compile', 'exec']
+    assert [r['phase'] for r in outer.report()] == phases[1:]
+    assert all(r['peak_memory'] >= 0 for r in outer.report())
+    assert all(r['calls'] == 1 for r in outer.report())
+
+
+def test_sparse(spec):
+    '''Test the sparse output mode against the dense output.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments)
+    f_sparse = function.compile_function('f', output, arguments, sparse=True)
+    assert f_sparse.ind.shape == (2, 3)
+    assert f_sparse.shape == (2, 2)
+
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    values = f_sparse(t, x)
+    assert values.shape == (4, 3)
+    np.testing.assert_equal(values, f(t, x)[(...,) + tuple(f_sparse.ind)])
+
+
+@pytest.mark.parametrize('options', [{}, dict(sparse=True)])
+def test_symmetric(options):
+    '''Test the deduplication of symmetric Hessian elements.'''
+    x = sympy.symbols('x:3')
+    L = sympy.exp(x[0] * x[1]) * sympy.sin(x[2])
+    hess = sympy.derive_by_array(sympy.derive_by_array(L, x), x).tolist()
+    arguments = function.Arguments(x=list(x))
+    printer = function.FunctionPrinter('hess', hess, arguments, cse=False,
+                                       **options)
+    assert len(printer.duplicates) == 3
+    full = function.FunctionPrinter('hess', hess, arguments, cse=False,
+                                    dedupe=False, **options)
+    assert len(printer.print_def()) < len(full.print_def())
+    f = printer.callable()
+    x = np.random.standard_normal((4, 3))
+    dense = function.compile_function('hess', hess, arguments)(x)
+    if options:
+        dense = dense[(...,) + tuple(f.ind)]
+    np.testing.assert_allclose(f(x), dense)
+    
+    if not options:
+        with pytest.raises(ValueError):
+            function.FunctionPrinter('hess', hess, arguments, selector='tril')
+        return
+    f_tril = function.compile_function('hess', hess, arguments,
+                                       selector='tril', **options)
+    assert f_tril.ind.shape == (2, 6)
+    assert all(i >= j for i, j in f_tril.ind.T)
+    np.testing.assert_allclose(f_tril(x), dense[..., [0, 3, 4, 6, 7, 8]])
+
+
+def test_out(spec):
+    '''Test writing the output into a caller-provided array.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments)
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    out = np.full((4, 2, 2), np.nan)
+    assert f(t, x, out=out) is out
+    np.testing.assert_equal(out, f(t, x))
+
+    with pytest.raises(ValueError):
+        f(t, x, out=np.zeros((3, 2, 2)))
+
+
+@pytest.mark.parametrize('chunk', [1, 3, True])
+def test_chunk(spec, chunk):
+    '''Test chunked evaluation against the unchunked function.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments)
+    f_chunk = function.compile_function('f', output, arguments, chunk=chunk)
+    t = np.random.standard_normal((5, 1))
+    x = np.random.standard_normal((5, 3, 2))
+    np.testing.assert_allclose(f_chunk(t, x), f(t, x))
+    np.testing.assert_allclose(f_chunk(1.0, x[0, 0]), f(1.0, x[0, 0]))
+
+
+@pytest.mark.parametrize('shape', [(50000,), (2, 25000), (25000, 2),
+                                   (2, 5, 5000)])
+def test_chunk_memory(spec, shape):
+    '''Test that the temporary arrays are bounded by the chunk size.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments)
+    f_chunk = function.compile_function('f', output, arguments, chunk=1024)
+    t = np.random.standard_normal(shape)
+    x = np.random.standard_normal(shape + (2,))
+    out = np.empty(shape + (2, 2))
+    f_chunk(t, x, out=out)
+    tracemalloc.start()
+    try:
+        f_chunk(t, x, out=out)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 32 * 1024 * out.itemsize
+    np.testing.assert_allclose(out, f(t, x))
+
+
+@pytest.mark.parametrize('options', [dict(threads=2),
+                                     dict(threads=3, chunk=4),
+                                     dict(threads=4, layout='batch_last')])
+def test_threads(spec, options):
+    '''Test threaded evaluation against the single-threaded function.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments, **options)
+    options.pop('threads')
+    f_serial = function.compile_function('f', output, arguments, **options)
+    t = np.random.standard_normal((9, 1))
+    x = np.random.standard_normal((2, 9, 3)
+                                  if options.get('layout') else (9, 3, 2))
+    np.testing.assert_array_equal(f(t, x), f_serial(t, x))
+    np.testing.assert_array_equal(f(1.0, [1.0, 2.0]), f_serial(1.0, [1, 2]))
+
+
+@pytest.mark.parametrize('shape', [(1, 1000), (3, 1000), (3, 2, 500)])
+def test_threads_partition(spec, shape, monkeypatch):
+    '''Test that short leading axes are partitioned for all threads.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments, threads=8)
+    executor = inspect.unwrap(f).__globals__['_thread_pool8']
+    chunks = []
+    
+    def chunk_map(fn, iterable):
+        chunks.extend(iterable)
+        return map(fn, chunks)
+    monkeypatch.setattr(executor, 'map', chunk_map)
+    t = np.random.standard_normal(shape)
+    x = np.random.standard_normal(shape + (2,))
+    f_serial = function.compile_function('f', output, arguments)
+    np.testing.assert_array_equal(f(t, x), f_serial(t, x))
+    assert len(chunks) >= 8
+
+
+def test_numba_backend(spec):
+    '''Test the numba backend against the numpy backend.'''
+    pytest.importorskip('numba')
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments)
+    f_numba = function.compile_function('f', output, arguments, backend='numba')
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((3, 1, 2))
+    np.testing.assert_allclose(f_numba(t, x), f(t, x))
+    np.testing.assert_allclose(f_numba(t[0], x[0, 0]), f(t[0], x[0, 0]))
+
+
+@pytest.mark.parametrize('options', [dict(backend='numba', threads=2),
+                                     dict(backend='c', threads=2),
+                                     dict(backend='c', dtype='float16')])
+def test_unsupported_options(spec, options):
+    '''Test that unsupported backend options are rejected.'''
+    output, arguments = spec
+    with pytest.raises(ValueError):
+        function.function_printer_class(options['backend'])(
+            'f', output, arguments, **options
+        )
+
+
+@pytest.mark.parametrize('options', [{}, dict(sparse=True), dict(dtype='float32'),
+                                     dict(layout='batch_last')])
+def test_c_backend(spec, options, tmp_path, monkeypatch):
+    '''Test the C backend against the numpy backend.'''
+    if shutil.which(os.environ.get('CC', 'cc')) is None:
+        pytest.skip('C compiler not found')
+    monkeypatch.setenv('SYM2NUM_CACHE_DIR', str(tmp_path))
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments, **options)
+    f_c = function.compile_function('f', output, arguments, backend='c',
+                                    **options)
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((3, 1, 2))
+    x0 = x[0, 0]
+    if options.get('layout'):
+        x = utils.to_batch_last(x, 1)
+    np.testing.assert_allclose(f_c(t, x), f(t, x), rtol=1e-6)
+    np.testing.assert_allclose(f_c(t[0], x0), f(t[0], x0), rtol=1e-6)
+    assert len(list(tmp_path.glob('lib/*.so'))) == 1
+
+
+@pytest.mark.parametrize('options', [{}, dict(chunk=2), dict(sparse=True)])
+def test_batch_last(spec, options):
+    '''Test the batch-last layout against the default layout.'''
+    output, arguments = spec
+    f = function.compile_function('f', output, arguments, **options)
+    f_bl = function.compile_function('f', output, arguments,
+                                     layout='batch_last', **options)
+    t = np.random.standard_normal((3, 1))
+    x = np.random.standard_normal((3, 4, 2))
+    out_ndim = 1 if options.get('sparse') else 2
+    expected = utils.to_batch_last(f(t, x), out_ndim)
+    np.testing.assert_allclose(f_bl(t, utils.to_batch_last(x, 1)), expected)
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'numexpr'])
+def test_float32(spec, backend):
+    '''Test single-precision code generation.'''
+    if backend == 'numexpr':
+        pytest.importorskip('numexpr')
+    output, arguments = spec
+    output = [[o / 3 + sympy.pi for o in row] for row in output]
+    f = function.compile_function('f', output, arguments)
+    f32 = function.compile_function('f', output, arguments,
+                                    dtype='float32', backend=backend)
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    assert f32(t, x).dtype == np.float32
+    assert f32(t[0], x[0]).dtype == np.float32
+    np.testing.assert_allclose(f32(t, x), f(t, x), rtol=1e-5)
+    if backend == 'numexpr':
+        # The constants are passed to numexpr in single precision
+        printer = function.function_printer('f', output, arguments,
+                                            dtype='float32', backend=backend)
+        assert 'local_dict' in printer.print_def()
+
+
+def test_numexpr_backend(spec):
+    '''Test the numexpr backend, with numpy fallback for callables.'''
+    pytest.importorskip('numexpr')
+    output, arguments = spec
+    t, x1, x2 = sympy.symbols('t, x1, x2')
+    h = var.UnivariateCallable('h')
+    output = [*output, [h(t) * x1, sympy.sign(x2)]]
+    arguments = function.Arguments(t=t, x=[x1, x2], h=h)
+    f = function.compile_function('f', output, arguments)
+    f_ne = function.compile_function('f', output, arguments,
+                                     backend='numexpr')
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    np.testing.assert_allclose(f_ne(t, x, np.cos), f(t, x, np.cos))
+
+
+def test_cse(spec):
+    '''Test the common subexpression elimination settings.'''
+    output, arguments = spec
+    t, x1, x2 = sympy.symbols('t, x1, x2')
+    h = var.UnivariateCallable('h')
+    output = [*output, [h(t * x1) * sympy.exp(x2), h(t * x1, 1) / (t * x1)]]
+    arguments = function.Arguments(t=t, x=[x1, x2], h=h)
+    printer = function.FunctionPrinter('f', output, arguments)
+    stats = printer.cse_stats
+    assert stats.subexpressions > 0
+    assert stats.ops_after < stats.ops_before
+    
+    off = function.FunctionPrinter('f', output, arguments, cse=False)
+    assert off.cse_stats == (0, stats.ops_before, stats.ops_before)
+    assert '_cse' not in off.print_def()
+    min_ops = function.FunctionPrinter('f', output, arguments,
+                                       cse=dict(min_ops=2))
+    assert min_ops.cse_stats.subexpressions < stats.subexpressions
+    
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    h = lambda y, dy=0: np.cos(y) if dy else np.sin(y)
+    expected = off.callable()(t, x, h)
+    np.testing.assert_allclose(printer.callable()(t, x, h), expected)
+    np.testing.assert_allclose(min_ops.callable()(t, x, h), expected)
+
+
+def test_fused(spec):
+    '''Test fused functions against their members.'''
+    output, arguments = spec
+    jac = np.empty((2, 2, 2), object)
+    x = arguments['x']
+    for i, j in np.ndindex(2, 2):
+        jac[:, i, j] = [sympy.diff(output[i][j], xk) for xk in x]
+    outputs = dict(f=output, jac=jac)
+    printer = function.FusedFunctionPrinter('f_and_jac', outputs, arguments)
+    f_and_jac = printer.callable()
+    f = function.compile_function('f', output, arguments)
+    df = function.compile_function('df', jac, arguments)
+
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    f_val, df_val = f_and_jac(t, x)
+    np.testing.assert_allclose(f_val, f(t, x))
+    np.testing.assert_allclose(df_val, df(t, x))
+
+
+def test_dag_derivative(spec):
+    '''Test printing derivatives computed over a subexpression DAG.'''
+    output, arguments = spec
+    x = arguments['x']
+    dag, jac = utils.ndexpr_dag_diff(output, x)
+    dag, hess = utils.ndexpr_dag_diff(jac, x, dag)
+    hess_printer = function.FunctionPrinter(
+        'hess', hess, arguments, subexpressions=dag
+    )
+    expected = utils.ndexpr_diff(utils.ndexpr_diff(output, x), x)
+    hess_expected = function.compile_function('hess', expected, arguments)
+    
+    t = np.random.standard_normal(4)
+    x = np.random.standard_normal((4, 2))
+    np.testing.assert_allclose(hess_printer.callable()(t, x),
+                               hess_expected(t, x))
+
+
+def test_parallel_print(spec):
+    '''Test that printing in worker processes matches serial printing.'''
+    output, arguments = spec
+    t, x1, x2 = sympy.symbols('t, x1, x2')
+    h = var.UnivariateCallable('h')
+    h_arguments = function.Arguments(t=t, x=arguments['x'], h=h)
+    outputs = dict(f=output, g=[h(t) * x1, h(t, 1)])
+    masked = [getmaskarray(x1) * x2, x1]
+    printers = [
+        function.FunctionPrinter('f', output, arguments, sparse=True),
+        function.FunctionPrinter('g', outputs['g'], h_arguments),
+        function.FusedFunctionPrinter('fg', outputs, h_arguments),
+        function.FunctionPrinter('masked', masked, arguments),
+    ]
+    serial = [(p.print_imports(), p.print_preamble(), p.print_def())
+              for p in printers]
+    assert parallel.print_functions(printers, 2) == serial
@@ -0,0 +1,97 @@
+'''Generated model class options test.'''
+
+
+import numpy as np
+import sympy
+
+from sym2num import codecache, model, profiling
+
+
+class OptionsModel(model.Base):
+    '''Model for testing the options of the generated class.'''
+
+    generate_functions = ['f', 'g', 'df_dx']
+    generate_fused = {'fg': ['f', 'g']}
+
+    def __init__(self):
+        super().__init__()
+        self.variables['x'] = ['x1', 'x2']
+        self.add_derivative('f', 'x', 'df_dx')
+
+    def f(self, x):
+        return [x[0] * sympy.sin(x[1]), 0, x[1] ** 2]
+
+    def g(self, x):
+        return x[0] ** 2 + x[1] ** 2
+
+
+def test_buffer_pool():
+    '''Test that the pooled methods reuse their output arrays.'''
+    generated = OptionsModel().compile_class(buffer_pool=True)()
+    x = np.random.standard_normal((4, 2))
+    first = generated.f(x)
+    second = generated.f(2 * x)
+    assert second is first
+    np.testing.assert_equal(second[:, 1], 0)
+    np.testing.assert_allclose(second[:, 2], 4 * x[:, 1] ** 2)
+    
+    other = generated.f(x[0])
+    assert other is not first
+    assert other.shape == (3,)
+    assert generated.f(x[1]) is other
+    
+    fresh = OptionsModel().compile_class()()
+    assert fresh.f(x) is not fresh.f(x)
+
+
+def test_out():
+    '''Test writing the outputs of the methods into given arrays.'''
+    generated = OptionsModel().compile_class()()
+    x = np.random.standard_normal((4, 2))
+    out = np.full((4, 3), np.nan)
+    assert generated.f(x, out=out) is out
+    np.testing.assert_equal(out[:, 1], 0)
+    np.testing.assert_allclose(out, generated.f(x))
+    
+    f_out = np.full((4, 3), np.nan)
+    g_out = np.empty(4)
+    f_value, g_value = generated.fg(x, out=(f_out, g_out))
+    assert f_value is f_out and g_value is g_out
+    np.testing.assert_allclose(f_out, generated.f(x))
+    np.testing.assert_allclose(g_out, generated.g(x))
+    
+    f_value, g_value = generated.fg(x, out=(None, g_out))
+    np.testing.assert_allclose(f_value, generated.f(x))
+    assert g_value is g_out
+
+
+def test_cache_key(tmp_path):
+    '''Test that a warm start with a cache key skips the symbolic work.'''
+    cache = codecache.CodeCache(tmp_path)
+    cold = OptionsModel().compile_class(cache=cache, cache_key='options-v1')
+    assert cache.cache_info().disk_hits == 0
+    
+    cache = codecache.CodeCache(tmp_path)
+    with profiling.profile() as p:
+        warm = OptionsModel().compile_class(cache=cache,
+                                            cache_key='options-v1')
+    assert cache.cache_info().disk_hits == 1
+    assert cache.cache_info().misses == 0
+    phases = {r['phase'] for r in p.report()}
+    assert not phases & {'default_output', 'differentiation'}
+    
+    x = np.random.standard_normal((4, 2))
+    np.testing.assert_equal(warm().df_dx(x), cold().df_dx(x))
+
+
+def test_mixed_precision():
+    '''Test the output dtypes of mixed-precision models.'''
+    generated = OptionsModel().compile_class(dtype='float32',
+                                             accumulate=['g'])()
+    x = np.random.standard_normal((4, 2))
+    assert generated.f(x).dtype == np.float32
+    assert generated.df_dx(x).dtype == np.float32
+    assert generated.g(x).dtype == np.float64
+    assert all(v.dtype == np.float64 for v in generated.fg(x))
+    np.testing.assert_allclose(generated.g(x), np.sum(x ** 2, -1))
+    np.testing.assert_allclose(generated.f(x), generated.fg(x)[0], rtol=1e-6)
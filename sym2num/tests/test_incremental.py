@@ -0,0 +1,65 @@
+'''Incremental model code generation test.'''
+
+
+import numpy as np
+import sympy
+
+from sym2num import codecache, model
+
+
+class IncrementalModel(model.Base):
+    '''Model for testing the incremental code generation.'''
+
+    generate_functions = ['f', 'g', 'df_dx']
+    generate_incremental = True
+    generated_name = 'GeneratedIncrementalModel'
+
+    def __init__(self):
+        super().__init__()
+        self.variables['x'] = ['x1', 'x2']
+        self.add_derivative('f', 'x', 'df_dx')
+
+    def f(self, x):
+        return [x[0] * sympy.sin(x[1]), x[1] ** 2]
+
+    def g(self, x):
+        return [x[0] ** 2]
+
+
+class EditedModel(IncrementalModel):
+    '''The incremental model with an edited function.'''
+
+    def g(self, x):
+        return [x[0] ** 3]
+
+
+def test_fingerprint():
+    '''Test that the fingerprints change only with their dependencies.'''
+    a = IncrementalModel()
+    b = EditedModel()
+    assert a.fingerprint('f') == b.fingerprint('f')
+    assert a.fingerprint('df_dx') == b.fingerprint('df_dx')
+    assert a.fingerprint('g') != b.fingerprint('g')
+
+    graph = a.dependency_graph(['df_dx'])
+    assert graph['function', 'df_dx'] == [('function', 'f'), ('variable', 'x')]
+
+
+def test_incremental():
+    '''Test that only the edited methods are regenerated.'''
+    cache = codecache.CodeCache()
+    IncrementalModel().compile_class(cache=cache)
+    assert cache.cache_info().misses == 4
+
+    edited = EditedModel()
+    with model.profiling.profile() as p:
+        Generated = edited.compile_class(cache=cache)
+    assert cache.cache_info().hits == 2
+    assert cache.cache_info().misses == 6
+    assert 'differentiation' not in p.summary()
+
+    x = np.array([1.5, 2.0])
+    generated = Generated()
+    np.testing.assert_allclose(generated.g(x), [1.5 ** 3])
+    np.testing.assert_allclose(generated.df_dx(x)[:, 0],
+                               [np.sin(2.0), 1.5 * np.cos(2.0)])
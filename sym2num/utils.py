@@ -30,18 +30,24 @@ except ModuleNotFoundError:
 
 
 class cached_class_property:
-    """Decorator to cache class properties."""
+    """Decorator to cache class properties.
+    
+    The value is cached separately for each class, so that subclasses
+    inheriting the property compute it from their own attributes.
+    """
     def __init__(self, getter):
         functools.update_wrapper(getter, self)
         self.getter = getter
+        self.values = {}
     
     def __get__(self, obj, cls=None):
-        if hasattr(self, 'value'):
-            return self.value
         if cls is None:
             cls = type(obj)
-        self.value = self.getter(cls)
-        return self.value
+        try:
+            return self.values[cls]
+        except KeyError:
+            value = self.values[cls] = self.getter(cls)
+            return value
 
 
 class classproperty:
@@ -93,6 +99,9 @@ def ndexpr_diff(ndexpr, wrt):
     array([[2*x, cos(x)],
            [2/z, 0]], dtype=object)
     
+    Each element is differentiated independently, so for large expressions
+    and higher order derivatives `ndexpr_dag_diff` is preferable.
+    
     """
     ndexpr = np.asarray(ndexpr)
     wrt = np.asarray(wrt)
@@ -103,6 +112,313 @@ def ndexpr_diff(ndexpr, wrt):
     return jac
 
 
+def ndexpr_dag_diff(ndexpr, wrt, subexpressions=(), symbols=None):
+    """Derivative of an array expression over a shared subexpression DAG.
+    
+    The array expression is first factored into common subexpressions, which
+    are appended to the `subexpressions` DAG, a sequence of `(symbol, expr)`
+    definitions in topological order. The derivatives are then computed by
+    forward accumulation over the DAG, with every nontrivial intermediate
+    derivative defined as a new subexpression. Consequently, the elements of
+    the result reference the shared intermediate symbols instead of
+    repeating their expressions, and higher order derivatives, obtained by
+    calling this function again with the returned DAG, grow linearly instead
+    of exponentially with the order.
+    
+    Returns the extended DAG and the derivative array, with the same shape as
+    `ndexpr_diff`. Both can be passed to `function.FunctionPrinter`, the
+    former as the `subexpressions` option.
+    
+    >>> from sympy import var, sin, exp
+    >>> x, y = var('x, y')
+    >>> f = [sin(x*y) * exp(x*y), x + y]
+    >>> dag, df = ndexpr_dag_diff(f, [x, y])
+    >>> expected = ndexpr_diff(f, [x, y])
+    >>> all(e.equals(a) for e, a in zip(expected.flat,
+    ...                                 ndexpr_expand(df, dag).flat))
+    True
+    >>> dag2, d2f = ndexpr_dag_diff(df, [x, y], dag)
+    >>> expected = ndexpr_diff(expected, [x, y])
+    >>> all(e.equals(a) for e, a in zip(expected.flat,
+    ...                                 ndexpr_expand(d2f, dag2).flat))
+    True
+    
+    """
+    subexpressions = list(subexpressions)
+    if symbols is None:
+        symbols = _dag_symbols(subexpressions)
+    
+    # Factor the expression into the DAG
+    new_subs, (reduced,) = ndexpr_cse([ndexpr], symbols)
+    subexpressions.extend(new_subs)
+    
+    primal = list(subexpressions)
+    nodes = _dag_nodes(subexpressions)
+    wrt = np.asarray(wrt)
+    jac = np.empty(wrt.shape + reduced.shape, dtype=object)
+    for i, wrt_elem in np.ndenumerate(wrt):
+        seed = {wrt_elem: sympy.S.One}
+        tangent = _forward_accumulation(primal, seed, subexpressions, nodes,
+                                        symbols)
+        
+        # Derivative of the output elements
+        for ind, expr in np.ndenumerate(reduced):
+            jac[i + ind] = _chain_rule(expr, tangent).xreplace(nodes)
+    return subexpressions, jac
+
+
+def ndexpr_dag_jvp(ndexpr, wrt, tangent, subexpressions=(), symbols=None):
+    """Jacobian-vector product of an array expression over a DAG.
+    
+    Directional derivative of `ndexpr` w.r.t. `wrt` along `tangent`, an
+    array with the shape of `wrt`, computed by a single forward accumulation
+    over the shared subexpression DAG, as in `ndexpr_dag_diff`. Returns the
+    extended DAG and the product, with the shape of `ndexpr`.
+    
+    >>> from sympy import var, sin
+    >>> x, y, u, v = var('x, y, u, v')
+    >>> f = [sin(x*y), x + y]
+    >>> dag, jvp = ndexpr_dag_jvp(f, [x, y], [u, v])
+    >>> ndexpr_expand(jvp, dag)
+    array([u*y*cos(x*y) + v*x*cos(x*y), u + v], dtype=object)
+    
+    """
+    subexpressions = list(subexpressions)
+    if symbols is None:
+        symbols = _dag_symbols(subexpressions)
+    
+    new_subs, (reduced,) = ndexpr_cse([ndexpr], symbols)
+    subexpressions.extend(new_subs)
+    
+    seed = {w: sympy.sympify(t) for w, t in zip(np.ravel(wrt), np.ravel(tangent))}
+    primal = list(subexpressions)
+    nodes = _dag_nodes(subexpressions)
+    tangent = _forward_accumulation(primal, seed, subexpressions, nodes,
+                                    symbols)
+    jvp = np.empty(reduced.shape, object)
+    for ind, expr in np.ndenumerate(reduced):
+        jvp[ind] = _chain_rule(expr, tangent).xreplace(nodes)
+    return subexpressions, jvp
+
+
+def ndexpr_dag_vjp(ndexpr, wrt, cotangent, subexpressions=(), symbols=None):
+    """Vector-Jacobian product of an array expression over a DAG.
+    
+    Derivative of `ndexpr` w.r.t. `wrt` contracted with `cotangent`, an
+    array with the shape of `ndexpr`, computed by reverse accumulation of
+    the adjoints over the shared subexpression DAG. Like in `ndexpr_dag_diff`
+    every nontrivial adjoint is defined as a new subexpression, so the size
+    of the result is proportional to that of the DAG, independently of the
+    size of `wrt`. Returns the extended DAG and the product, with the shape
+    of `wrt`.
+    
+    >>> from sympy import var, sin
+    >>> x, y, u, v = var('x, y, u, v')
+    >>> f = [sin(x*y), x + y]
+    >>> dag, vjp = ndexpr_dag_vjp(f, [x, y], [u, v])
+    >>> ndexpr_expand(vjp, dag)
+    array([u*y*cos(x*y) + v, u*x*cos(x*y) + v], dtype=object)
+    
+    """
+    subexpressions = list(subexpressions)
+    if symbols is None:
+        symbols = _dag_symbols(subexpressions)
+    
+    new_subs, (reduced,) = ndexpr_cse([ndexpr], symbols)
+    subexpressions.extend(new_subs)
+    
+    # Reverse accumulation of the adjoints of the DAG nodes
+    nodes = _dag_nodes(subexpressions)
+    adjoint = collections.defaultdict(list)
+    cotangent = np.asarray(cotangent, object)
+    for ind, expr in np.ndenumerate(reduced):
+        _accumulate_adjoint(expr, sympy.sympify(cotangent[ind]), adjoint)
+    for symbol, expr in reversed(list(subexpressions)):
+        a = sympy.Add(*adjoint.pop(symbol, []))
+        if a == 0:
+            continue
+        a = _define_node(a, subexpressions, nodes, symbols)
+        _accumulate_adjoint(expr, a, adjoint)
+    
+    wrt = np.asarray(wrt)
+    vjp = np.empty(wrt.shape, object)
+    for ind, wrt_elem in np.ndenumerate(wrt):
+        vjp[ind] = sympy.Add(*adjoint.get(wrt_elem, [])).xreplace(nodes)
+    return subexpressions, vjp
+
+
+def _dag_symbols(subexpressions):
+    """Generator of new symbols for a subexpression DAG."""
+    exclude = [s for s, e in subexpressions]
+    start = len(subexpressions)
+    return sympy.numbered_symbols('_dag', start=start, exclude=exclude)
+
+
+def _dag_nodes(subexpressions):
+    """Mapping of the expressions of the DAG nodes to their symbols."""
+    return {expr: symbol for symbol, expr in subexpressions}
+
+
+def _define_node(expr, subexpressions, nodes, symbols):
+    """Symbol of a DAG node with the given expression, defined if new.
+    
+    The subexpressions already in the DAG, such as `exp(u)` in its
+    derivative, are replaced by their symbols, and identical nodes are
+    defined only once. Atomic expressions are returned as they are.
+    """
+    expr = expr.xreplace(nodes)
+    if expr.is_Atom:
+        return expr
+    symbol = next(symbols)
+    subexpressions.append((symbol, expr))
+    nodes[expr] = symbol
+    return symbol
+
+
+def _forward_accumulation(primal, seed, subexpressions, nodes, symbols):
+    """Tangents of the nodes of a DAG given the tangents of its inputs.
+    
+    The nontrivial tangents are defined as new subexpressions with
+    `_define_node`, appended to `subexpressions`.
+    """
+    tangent = dict(seed)
+    for symbol, expr in primal:
+        d = _chain_rule(expr, tangent)
+        tangent[symbol] = _define_node(d, subexpressions, nodes, symbols)
+    return tangent
+
+
+def _accumulate_adjoint(expr, expr_adjoint, adjoint):
+    """Add the contributions of an expression to the adjoints of its symbols."""
+    expr = sympy.sympify(expr)
+    for symbol in expr.free_symbols:
+        adjoint[symbol].append(sympy.diff(expr, symbol) * expr_adjoint)
+
+
+def _chain_rule(expr, tangent):
+    """Apply the chain rule with the given tangents of the free symbols."""
+    expr = sympy.sympify(expr)
+    terms = []
+    for symbol in expr.free_symbols:
+        d_symbol = tangent.get(symbol, 0)
+        if d_symbol != 0:
+            terms.append(sympy.diff(expr, symbol) * d_symbol)
+    return sympy.Add(*terms)
+
+
+def ndexpr_expand(ndexpr, subexpressions):
+    """Replace the symbols of a subexpression DAG by their expressions."""
+    expanded = {}
+    for symbol, expr in subexpressions:
+        expanded[symbol] = sympy.sympify(expr).xreplace(expanded)
+    ndexpr = np.asarray(ndexpr, object)
+    out = np.empty(ndexpr.shape, object)
+    for ind, expr in np.ndenumerate(ndexpr):
+        out[ind] = sympy.sympify(expr).xreplace(expanded)
+    return out
+
+
+def prune_subexpressions(subexpressions, exprs):
+    """Select the subexpression definitions required to evaluate `exprs`.
+    
+    >>> from sympy import var
+    >>> a, b, c, x = var('a, b, c, x')
+    >>> prune_subexpressions([(a, x**2), (b, a + 1), (c, x)], [b * x])
+    [(a, x**2), (b, a + 1)]
+    
+    """
+    required = union(sympy.sympify(e).free_symbols for e in exprs)
+    selected = []
+    for symbol, expr in reversed(list(subexpressions)):
+        if symbol in required:
+            selected.append((symbol, expr))
+            required |= sympy.sympify(expr).free_symbols
+    selected.reverse()
+    return selected
+
+
+def ndexpr_xreplace(ndexpr, mapping):
+    """Simultaneous replacement in all elements of an array expression.
+    
+    Like `sympy.Basic.xreplace`, but the keys can also be function classes,
+    which replaces all their applications, and the rebuilt subtrees are
+    cached across all elements, so that shared subtrees are only processed
+    once.
+    
+    >>> from sympy import Function, var
+    >>> x, y = var('x, y'); f, g = Function('f'), Function('g')
+    >>> ndexpr_xreplace([f(x) + y, x * y], {x: y, y: x, f: g})
+    array([x + g(y), x*y], dtype=object)
+    
+    """
+    cache = {}
+    
+    def rebuild(expr):
+        try:
+            return cache[expr]
+        except KeyError:
+            pass
+        
+        if expr in mapping:
+            result = mapping[expr]
+        elif expr.args:
+            args = tuple(rebuild(arg) for arg in expr.args)
+            func = mapping.get(expr.func, expr.func)
+            unchanged = all(a is b for a, b in zip(args, expr.args))
+            if unchanged and func is expr.func:
+                result = expr
+            else:
+                try:
+                    result = func(*args)
+                except (TypeError, ValueError):
+                    # Some expressions, like derivatives w.r.t. a replaced
+                    # symbol, can only be handled by `subs`
+                    result = expr.subs(mapping, simultaneous=True)
+        else:
+            result = expr
+        
+        cache[expr] = result
+        return result
+    
+    ndexpr = np.asarray(ndexpr, object)
+    out = np.empty(ndexpr.shape, object)
+    for ind, expr in np.ndenumerate(ndexpr):
+        out[ind] = rebuild(sympy.sympify(expr))
+    return out
+
+
+def ndexpr_cse(ndexprs, symbols=None, **kwargs):
+    """Common subexpression elimination of several array expressions.
+    
+    Returns the list of `(symbol, expression)` substitutions and the list of
+    arrays with the reduced expressions. Additional keyword arguments are
+    passed to `sympy.cse`.
+    
+    >>> import sympy
+    >>> x, y = sympy.symbols('x, y')
+    >>> subs, (a, b) = ndexpr_cse([[sympy.sin(x)**2, y], sympy.sin(x) + 1])
+    >>> subs
+    [(_cse0, sin(x))]
+    >>> a, b
+    (array([_cse0**2, y], dtype=object), array(_cse0 + 1, dtype=object))
+    
+    """
+    if symbols is None:
+        symbols = sympy.numbered_symbols('_cse')
+    arrays = [np.asarray(ndexpr, object) for ndexpr in ndexprs]
+    flat = [sympy.sympify(e) for a in arrays for e in a.flat]
+    subs, flat_reduced = sympy.cse(flat, symbols, **kwargs)
+    
+    reduced = []
+    flat_iter = iter(flat_reduced)
+    for a in arrays:
+        r = np.empty(a.shape, object)
+        for ind in np.ndindex(*a.shape):
+            r[ind] = next(flat_iter)
+        reduced.append(r)
+    return subs, reduced
+
+
 def flat_cat(*args, **kwargs):
     """Concatenate flattened arrays."""
     chain = list(itertools.chain(args, kwargs.values()))
@@ -112,8 +428,11 @@ def flat_cat(*args, **kwargs):
         return np.concatenate([np.asanyarray(a).flatten() for a in chain])
 
 
-def make_signature(arg_names, member=False):
-    """Make Signature object from argument name iterable or str."""
+def make_signature(arg_names, member=False, kwonly={}):
+    """Make Signature object from argument name iterable or str.
+    
+    The `kwonly` mapping specifies keyword-only parameters and defaults.
+    """
     kind = inspect.Parameter.POSITIONAL_OR_KEYWORD
     
     if isinstance(arg_names, str):
@@ -121,15 +440,19 @@ def make_signature(arg_names, member=False):
     if member and arg_names and arg_names[0] != 'self':
         arg_names = ['self'] + arg_names
     
-    return inspect.Signature([inspect.Parameter(n, kind) for n in arg_names])
+    params = [inspect.Parameter(n, kind) for n in arg_names]
+    for name, default in kwonly.items():
+        kw = inspect.Parameter.KEYWORD_ONLY
+        params.append(inspect.Parameter(name, kw, default=default))
+    return inspect.Signature(params)
 
 
-def wrap_with_signature(arg_name_list, member=False):
+def wrap_with_signature(arg_name_list, member=False, kwonly={}):
     def decorator(f):
         @functools.wraps(f)
-        def wrapper(*args):
-            return f(*args)
-        wrapper.__signature__ = make_signature(arg_name_list, member)
+        def wrapper(*args, **kwargs):
+            return f(*args, **kwargs)
+        wrapper.__signature__ = make_signature(arg_name_list, member, kwonly)
         return wrapper
     return decorator
 
@@ -154,9 +477,93 @@ def sparsify(array, selector=None):
         return np.array([]), np.zeros((array.ndim, 0), int)
 
 
+def _ravel_index(ind, shape):
+    """Flat indices into the C-ordered raveled array of the given shape."""
+    if not shape:
+        return np.zeros(np.shape(ind)[1:], int)
+    return np.ravel_multi_index(tuple(ind), shape)
+
+
+def sparse_matrix(values, ind, shape, format='coo', rowdims=1):
+    """Build a `scipy.sparse` matrix from nonzero values and their indices.
+    
+    The first `rowdims` dimensions of the dense `shape` are raveled into the
+    matrix rows and the remaining dimensions into the columns. If `values`
+    has leading batch dimensions, the result is the block-diagonal matrix of
+    all batch elements, in C order. No dense array is created in the process.
+    
+    >>> ind = np.array([[0, 1, 1], [1, 0, 2]])
+    >>> sparse_matrix([1.0, 2.0, 3.0], ind, (2, 3)).toarray()
+    array([[0., 1., 0.],
+           [2., 0., 3.]])
+    >>> sparse_matrix([[1, 2, 3], [4, 5, 6]], ind, (2, 3), 'csr').shape
+    (4, 6)
+    
+    """
+    from scipy import sparse
+    
+    values = np.asarray(values)
+    ind = np.asarray(ind)
+    shape = tuple(shape)
+    if len(shape) != len(ind):
+        raise ValueError("number of indices does not match dense shape")
+    nrows = int(np.prod(shape[:rowdims]))
+    ncols = int(np.prod(shape[rowdims:]))
+    rows = _ravel_index(ind[:rowdims], shape[:rowdims])
+    cols = _ravel_index(ind[rowdims:], shape[rowdims:])
+    
+    nblocks = int(np.prod(values.shape[:-1]))
+    offsets = np.arange(nblocks)[:, None]
+    rows = (offsets * nrows + rows).ravel()
+    cols = (offsets * ncols + cols).ravel()
+    data = values.ravel()
+    matrix_shape = (nblocks * nrows, nblocks * ncols)
+    matrix = sparse.coo_matrix((data, (rows, cols)), shape=matrix_shape)
+    return matrix.asformat(format)
+
+
+def to_batch_last(array, ndim):
+    """Move the leading batch dimensions of an array to the end.
+    
+    Converts arrays of the default 'batch_first' layout of the generated
+    functions, with `ndim` element dimensions, to the 'batch_last' layout.
+    Returns a contiguous copy, so that each element array is contiguous.
+    
+    >>> to_batch_last(np.zeros((5, 4, 2, 3)), 2).shape
+    (2, 3, 5, 4)
+    
+    """
+    array = np.asarray(array)
+    batch_ndim = array.ndim - ndim
+    moved = np.moveaxis(array, range(batch_ndim), range(ndim, array.ndim))
+    return np.ascontiguousarray(moved)
+
+
+def to_batch_first(array, ndim):
+    """Move the trailing batch dimensions of an array to the front.
+    
+    Converts arrays of the 'batch_last' layout of the generated functions,
+    with `ndim` element dimensions, to the default 'batch_first' layout.
+    Returns a contiguous copy.
+    
+    >>> to_batch_first(np.zeros((2, 3, 5, 4)), 2).shape
+    (5, 4, 2, 3)
+    
+    """
+    array = np.asarray(array)
+    batch_ndim = array.ndim - ndim
+    moved = np.moveaxis(array, range(ndim, array.ndim), range(batch_ndim))
+    return np.ascontiguousarray(moved)
+
+
 def istril(*index):
-    """Return whether and index is in the lower triangle of an array."""
-    return index[0] <= index[1]
+    """Return whether an index is in the lower triangle of an array.
+    
+    >>> istril(1, 0), istril(1, 1), istril(0, 1)
+    (True, True, False)
+    
+    """
+    return index[0] >= index[1]
 
 
 def isstr(obj):